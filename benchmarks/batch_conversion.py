@@ -0,0 +1,109 @@
+"""
+Microbenchmark of the conversions between sentences and padded batches in utils.DataReader, against the row by row
+implementations they replaced.
+
+    python -m benchmarks.batch_conversion
+
+Also times the lookup of words by np.searchsorted on a sorted array of the vocabulary, the vectorized alternative
+to the dict lookup kept in create_batch.
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import timeit
+from itertools import chain
+
+import numpy as np
+
+from utils import AttrDict, DataReader
+
+
+def create_batch_rows(word2idx, sents):
+    indices = []
+    for sent in sents:
+        x = [word2idx.get(word, 1) for word in (sent + [u"</S>"])]  # 1: OOV, </S>: End of Text
+        indices.append(x)
+    maxlen = max([len(s) for s in indices])
+    X = np.zeros([len(indices), maxlen], np.int32)
+    for i, x in enumerate(indices):
+        X[i, :len(x)] = x
+    return X
+
+
+def create_batch_searchsorted(sorted_words, sorted_indices, sents):
+    lengths = np.array([len(sent) for sent in sents])
+    words = np.array(list(chain.from_iterable(sents)), dtype=np.unicode_)
+    positions = np.minimum(np.searchsorted(sorted_words, words), len(sorted_words) - 1)
+    flat = np.where(sorted_words[positions] == words, sorted_indices[positions], 1).astype(np.int32)  # 1: OOV
+    return DataReader.pad_batch(flat, lengths)
+
+
+def pad_batch_rows(indices):
+    maxlen = max([len(x) for x in indices]) + 1
+    X = np.zeros([len(indices), maxlen], np.int32)
+    for i, x in enumerate(indices):
+        X[i, :len(x)] = x
+        X[i, len(x)] = 3  # </S>: End of Text
+    return X
+
+
+def indices_to_words_rows(idx2word, Y):
+    sents = []
+    for y in Y:
+        sent = []
+        for i in y:
+            if i == 3:  # </S>
+                break
+            sent.append(idx2word[i])
+        sents.append(' '.join(sent))
+    return sents
+
+
+def main(vocab_size=30000, batch_size=200, max_length=60, number=100, repeat=5):
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        vocab_path = os.path.join(tmp_dir, 'vocab')
+        with open(vocab_path, 'w') as f:
+            f.write(''.join('{}\t0\n'.format(w) for w in
+                            ['<PAD>', '<UNK>', '<S>', '</S>'] + ['w%d' % i for i in range(4, vocab_size)]))
+        config = AttrDict(src_vocab=vocab_path, dst_vocab=vocab_path,
+                          src_vocab_size=vocab_size, dst_vocab_size=vocab_size)
+        reader = DataReader(config)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # Include some OOV words.
+    sents = [[u'w%d' % i for i in rng.randint(4, vocab_size + 100, rng.randint(1, max_length + 1))]
+             for _ in range(batch_size)]
+    indices = [[reader.dst2idx.get(w, 1) for w in sent] for sent in sents]
+    arrays = [np.array(x, np.int32) for x in indices]
+    Y = reader.create_batch(sents, o='dst')
+    sorted_words = np.array(sorted(reader.dst2idx), dtype=np.unicode_)
+    sorted_indices = np.array([reader.dst2idx[w] for w in sorted_words], np.int32)
+
+    assert (create_batch_rows(reader.dst2idx, sents) == Y).all()
+    assert (create_batch_searchsorted(sorted_words, sorted_indices, sents) == Y).all()
+    assert (pad_batch_rows(indices) == Y).all()
+    assert (reader.pad_batch(arrays) == Y).all()
+    assert indices_to_words_rows(reader.idx2dst, Y) == reader.indices_to_words(Y)
+
+    cases = [
+        ('create_batch', lambda: create_batch_rows(reader.dst2idx, sents), lambda: reader.create_batch(sents, 'dst')),
+        ('create_batch (searchsorted)', lambda: create_batch_rows(reader.dst2idx, sents),
+         lambda: create_batch_searchsorted(sorted_words, sorted_indices, sents)),
+        ('pad_batch', lambda: pad_batch_rows(indices), lambda: reader.pad_batch(indices)),
+        ('pad_batch (arrays)', lambda: pad_batch_rows(arrays), lambda: reader.pad_batch(arrays)),
+        ('indices_to_words', lambda: indices_to_words_rows(reader.idx2dst, Y), lambda: reader.indices_to_words(Y)),
+    ]
+    print('{} sentences of 1-{} words, {} vocab, best of {}x{} runs'.format(batch_size, max_length, vocab_size,
+                                                                          repeat, number))
+    for name, before, after in cases:
+        times = [min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1000 for fn in (before, after)]
+        print('{:<28}before: {:.2f} ms/batch  after: {:.2f} ms/batch'.format(name, *times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import logging
+import os
+from argparse import ArgumentParser
+
+import yaml
+
+from utils import AttrDict, BinaryCorpus, DataReader
+
+
+def binarize(fpath, word2idx, prefix):
+    """Converts a tokenized text file into a binary corpus.
+
+    Args:
+      fpath: A string. Input file path.
+      word2idx: A dict. Maps words to indices, unknown words are mapped to 1 (<UNK>).
+      prefix: A string. Output path prefix.
+
+    Writes token indices to `prefix`.bin and sentence offsets to `prefix`.idx.npy, which can be read by
+    utils.BinaryCorpus.
+    """
+    # Lines are split on '\n' only, like DataReader reads the text files, so that the sentences are aligned with
+    # their lines. Unicode line breaks such as u'\x85' and u'\u2028' are taken as spaces.
+    sents = ([word2idx.get(word, 1) for word in l.decode('utf8').split()] for l in open(fpath, 'r'))
+    BinaryCorpus.write(sents, prefix)
+    logging.info('Binary corpus: {}\tsentences: {}'.format(prefix, len(BinaryCorpus(prefix))))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config')
+    args = parser.parse_args()
+    # Read config
+    config = AttrDict(yaml.load(open(args.config)))
+    logging.basicConfig(level=logging.INFO)
+    data_reader = DataReader(config)
+    for path, bin_path, word2idx in [(config.train.src_path, config.train.src_bin_path, data_reader.src2idx),
+                                     (config.train.dst_path, config.train.dst_bin_path, data_reader.dst2idx)]:
+        if os.path.exists(bin_path + '.idx.npy'):
+            logging.info('Binary corpus already exists at {}'.format(bin_path))
+        else:
+            binarize(path, word2idx, bin_path)
+    logging.info("Done")
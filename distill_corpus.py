@@ -0,0 +1,87 @@
+import logging
+import os
+import shutil
+from argparse import ArgumentParser
+
+import yaml
+
+from evaluate import Evaluator
+from utils import AttrDict
+
+
+def part_path(output_path, part):
+    return '{}.parts/part-{:05d}'.format(output_path, part)
+
+
+def distill_corpus(config, src_path, output_path, part_size=100000, num_jobs=1, job=0):
+    """Translates a corpus with a teacher model for sequence-level distillation.
+
+    The corpus is translated in parts of `part_size` lines, which are saved in `output_path`.parts as soon as they
+    are done, so that an interrupted run can be resumed by running it again. Parts can be shared by `num_jobs`
+    processes (e.g. one per GPU or host), of which this is the `job`-th. The job which finds all parts done merges
+    them into `output_path`, whose lines are aligned with `src_path`.
+
+    Args:
+      config: The config of the teacher model. Sentences are sorted by length in batches (see test.sort_by_length),
+        which are split over all test towers.
+      src_path: A string. The source corpus, e.g. train.src_path of the student.
+      output_path: A string. The distilled target corpus, e.g. train.dst_path of the student.
+      part_size: An int. Number of lines in a part.
+      num_jobs: An int. Number of processes sharing the parts.
+      job: An int. Index of this process.
+    """
+    if config.test.sort_by_length is None:
+        config.test['sort_by_length'] = True
+    evaluator = Evaluator()
+    evaluator.init_from_config(config)
+    offsets = evaluator.data_reader.line_offsets(src_path)
+    num_lines = len(offsets) - 1
+    num_parts = (num_lines + part_size - 1) // part_size
+    if not os.path.exists(output_path + '.parts'):
+        os.makedirs(output_path + '.parts')
+
+    for part in range(job, num_parts, num_jobs):
+        path = part_path(output_path, part)
+        if os.path.exists(path):
+            logging.info('Part {} is already translated.'.format(part))
+            continue
+        start, end = part * part_size, min((part + 1) * part_size, num_lines)
+        with open(src_path, 'rb') as fin, open(path + '.src', 'wb') as fout:
+            fin.seek(offsets[start])
+            fout.write(fin.read(offsets[end] - offsets[start]))
+        # Keep BPE flags, the output is a training corpus.
+        evaluator.translate(path + '.src', path + '.tmp', config.test.batch_size, remove_bpe=False)
+        assert sum(1 for _ in open(path + '.tmp')) == end - start
+        os.rename(path + '.tmp', path)
+        os.remove(path + '.src')
+        logging.info('Part {} ({} lines) is translated.'.format(part, end - start))
+
+    paths = [part_path(output_path, part) for part in range(num_parts)]
+    if not all(os.path.exists(path) for path in paths):
+        logging.info('Parts of other jobs are not done, they will be merged by the last job.')
+        return
+    # Jobs finishing at the same time may all merge, each into its own temporary file. Renaming is atomic, so the
+    # output is one of the (identical) merged files.
+    tmp_path = '{}.tmp.{}'.format(output_path, job)
+    with open(tmp_path, 'wb') as fout:
+        for path in paths:
+            with open(path, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+    os.rename(tmp_path, output_path)
+    logging.info('The distilled corpus was saved in %s.' % output_path)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config', help='Config of the teacher model.')
+    parser.add_argument('-s', '--src', dest='src_path')
+    parser.add_argument('-o', '--output', dest='output_path')
+    parser.add_argument('--part_size', dest='part_size', type=int, default=100000)
+    parser.add_argument('--num_jobs', dest='num_jobs', type=int, default=1)
+    parser.add_argument('--job', dest='job', type=int, default=0)
+    args = parser.parse_args()
+    # Read config
+    config = AttrDict(yaml.load(open(args.config)))
+    logging.basicConfig(level=logging.INFO)
+    distill_corpus(config, args.src_path, args.output_path, args.part_size, args.num_jobs, args.job)
+    logging.info("Done")
@@ -3,6 +3,7 @@ from __future__ import print_function
 import codecs
 import commands
 import os
+import shutil
 import time
 import logging
 import tensorflow as tf
@@ -13,7 +14,7 @@ from tempfile import mkstemp
 import yaml
 
 from models import *
-from utils import DataReader, AttrDict, expand_feed_dict
+from utils import DataReader, AttrDict, TranslationCache, expand_feed_dict, balanced_partition
 
 
 def roll_back_to_previous_version(config):
@@ -38,14 +39,31 @@ def roll_back_to_previous_version(config):
     config.num_shards = 1
 
 
+def checkpoint_id(path):
+    """Identify a checkpoint (or a frozen graph) by its path and modification time, as a path may be reused."""
+    files = tf.gfile.Glob(path) + tf.gfile.Glob(path + '.*')
+    return '{}@{}'.format(path, max(tf.gfile.Stat(f).mtime_nsec for f in files))
+
+
 class Evaluator(object):
     """
     Evaluate the model.
     """
     def __init__(self):
-        pass
+        # Translations are cached only if the weights are known by a checkpoint id, i.e. not while training.
+        self.checkpoint_id = None
+        self.cache = None
+
+    def init_cache(self, config):
+        """Cache translations of up to test.cache_size sentences, which are saved in test.cache_path if given."""
+        if config.test.cache_size:
+            self.cache = TranslationCache(config.test.cache_size, config.test.cache_path)
+
+    def cache_key(self, sent):
+        return self.checkpoint_id, self.config.test.beam_size, self.config.test.lp_alpha, sent
 
     def init_from_config(self, config):
+        self.config = config
         self.model = eval(config.model)(config, config.test.num_gpus)
         self.model.build_test_model()
 
@@ -60,10 +78,13 @@ class Evaluator(object):
         except tf.errors.NotFoundError:
             roll_back_to_previous_version(config)
             tf.train.Saver().restore(self.sess, tf.train.latest_checkpoint(config.model_dir))
+        self.checkpoint_id = checkpoint_id(tf.train.latest_checkpoint(config.model_dir))
 
         self.data_reader = DataReader(config)
+        self.init_cache(config)
 
     def init_from_frozen_graphdef(self, config):
+        self.config = config
         frozen_graph_path = os.path.join(config.model_dir, 'frozen_graph.pb')
         # If the file doesn't existed, create it.
         if not os.path.exists(frozen_graph_path):
@@ -130,42 +151,96 @@ class Evaluator(object):
             self.model['src_pls'] = collect_placeholders('src_pl')
             self.model['dst_pls'] = collect_placeholders('dst_pl')
             self.model['predictions'] = graph.get_tensor_by_name('import/predictions:0')
+            self.checkpoint_id = checkpoint_id(frozen_graph_path)
+            self.init_cache(config)
 
-    def init_from_existed(self, model, sess, data_reader):
+    def init_from_existed(self, config, model, sess, data_reader):
+        self.config = config
         self.sess = sess
         self.model = model
         self.data_reader = data_reader
 
+    def get_partition(self, batch):
+        """Token-balanced partition of the batch for the test towers, or None if it is disabled."""
+        if not self.config.test.balance_towers:
+            return None
+        return balanced_partition(batch, len(self.model.src_pls))
+
     def beam_search(self, X):
-        return self.sess.run(self.model.predictions, feed_dict=expand_feed_dict({self.model.src_pls: X}))
+        partition = self.get_partition([X])
+        Y = self.sess.run(self.model.predictions,
+                          feed_dict=expand_feed_dict({self.model.src_pls: X}, partition))
+        if partition is not None:
+            # Predictions are concatenated in the order of the partition.
+            Y = Y[np.argsort(np.concatenate(partition))]
+        return Y
 
     def loss(self, X, Y):
-        return self.sess.run(self.model.loss_sum, feed_dict=expand_feed_dict({self.model.src_pls: X, self.model.dst_pls: Y}))
+        partition = self.get_partition([X, Y])
+        return self.sess.run(self.model.loss_sum,
+                             feed_dict=expand_feed_dict({self.model.src_pls: X, self.model.dst_pls: Y}, partition))
 
-    def translate(self, src_path, output_path, batch_size):
+    def translate(self, src_path, output_path, batch_size, remove_bpe=True):
         logging.info('Translate %s.' % src_path)
         _, tmp = mkstemp()
         fd = codecs.open(tmp, 'w', 'utf8')
+        cache = self.cache if self.checkpoint_id is not None else None
+        cache_info = ''
+        decode_path = src_path
+        if cache is not None:
+            # Sentences are looked up by their tokens, only distinct ones which are not cached are decoded.
+            keys = [u' '.join(line.decode('utf8').split()) for line in open(src_path)]
+            translations = {}
+            new_keys = []
+            for key in keys:
+                if key not in translations:
+                    translations[key] = cache.get(self.cache_key(key))
+                    if translations[key] is None:
+                        new_keys.append(key)
+            cache_info = ' Cache hits: {}, misses: {}.'.format(len(keys) - len(new_keys), len(new_keys))
+            _, decode_path = mkstemp()
+            with codecs.open(decode_path, 'w', 'utf8') as f:
+                for key in new_keys:
+                    print(key, file=f)
         count = 0
         token_count = 0
         epsilon = 1e-6
         start = time.time()
-        for X in self.data_reader.get_test_batches(src_path, batch_size):
+        # Batches may be sorted by length, outputs are written in the original order.
+        outputs = {}
+        next_index = 0
+        for indices, X in self.data_reader.get_test_batches_with_indices(decode_path, batch_size):
             Y = self.beam_search(X)
-            Y = Y[:len(X)]
+            Y = Y[:len(indices)]
             sents = self.data_reader.indices_to_words(Y)
-            assert len(X) == len(sents)
-            for sent in sents:
-                print(sent, file=fd)
-            count += len(X)
+            assert len(indices) == len(sents)
+            if cache is not None:
+                for index, sent in zip(indices, sents):
+                    translations[new_keys[index]] = sent
+                    cache.put(self.cache_key(new_keys[index]), sent)
+            else:
+                outputs.update(zip(indices, sents))
+                while next_index in outputs:
+                    print(outputs.pop(next_index), file=fd)
+                    next_index += 1
+            count += len(indices)
             token_count += np.sum(np.not_equal(Y, 3))  # 3: </s>
             time_span = time.time() - start
             logging.info('{0} sentences ({1} tokens) processed in {2:.2f} minutes (speed: {3:.4f} sec/token).'.
-                         format(count, token_count, time_span / 60, time_span / (token_count + epsilon)))
+                         format(count, token_count, time_span / 60, time_span / (token_count + epsilon)) + cache_info)
+        if cache is not None:
+            for key in keys:
+                print(translations[key], file=fd)
+            os.remove(decode_path)
+            cache.save()
+            logging.info('{} sentences translated.{}'.format(len(keys), cache_info))
         fd.close()
-        # Remove BPE flag, if have.
-        os.system("sed -r 's/(@@ )|(@@ ?$)//g' %s > %s" % (tmp, output_path))
-        os.remove(tmp)
+        if remove_bpe:
+            # Remove BPE flag, if have.
+            os.system("sed -r 's/(@@ )|(@@ ?$)//g' %s > %s" % (tmp, output_path))
+            os.remove(tmp)
+        else:
+            shutil.move(tmp, output_path)
         logging.info('The result file was saved in %s.' % output_path)
 
     def ppl(self, src_path, dst_path, batch_size):
@@ -205,20 +280,96 @@ class Evaluator(object):
         return bleu
 
 
+def dev_report_path(config):
+    return os.path.join(config.model_dir, 'dev_bleu.txt')
+
+
+def read_dev_reports(config):
+    """Read the (checkpoint path, BLEU) pairs reported by `watch_checkpoints`."""
+    report_path = dev_report_path(config)
+    if not os.path.exists(report_path):
+        return []
+    reports = []
+    for line in open(report_path):
+        if not line.endswith('\n'):  # The line is being written.
+            break
+        path, bleu = line.split('\t')
+        try:
+            reports.append((path, float(bleu)))
+        except ValueError:
+            logging.warning('Skip the dev report {}'.format(line.strip()))
+    return reports
+
+
+def watch_checkpoints(config, poll_interval=10):
+    """
+    Evaluate checkpoints saved in config.model_dir on the dev set in order, as a process apart from training.
+    The BLEU scores are appended to `dev_report_path(config)`, and the best checkpoint is copied to model_dir/best.
+    """
+    if not config.dev.ref_path:
+        raise Exception('dev.ref_path is required to evaluate checkpoints.')
+    evaluated = [path for path, _ in read_dev_reports(config)]
+    best_bleu = max([bleu for _, bleu in read_dev_reports(config)] or [None])
+    best_dir = os.path.join(config.model_dir, 'best')
+    evaluator = None
+    while True:
+        state = tf.train.get_checkpoint_state(config.model_dir)
+        paths = [p for p in state.all_model_checkpoint_paths if p not in evaluated] if state else []
+        if not paths:
+            time.sleep(poll_interval)
+            continue
+        path = paths[0]
+        if evaluator is None:
+            evaluator = Evaluator()
+            evaluator.init_from_config(config)
+            saver = tf.train.Saver()
+        logging.info('Evaluate {}.'.format(path))
+        evaluated.append(path)
+        # Old checkpoints are removed when new ones are saved, maybe before they are evaluated. Restoring a removed
+        # checkpoint raises NotFoundError or ValueError, depending on the version of TensorFlow.
+        try:
+            if not tf.train.checkpoint_exists(path):
+                logging.warning('{} is removed before evaluated.'.format(path))
+                continue
+            saver.restore(evaluator.sess, path)
+            evaluator.checkpoint_id = checkpoint_id(path)
+        except (tf.errors.NotFoundError, ValueError):
+            logging.warning('{} is removed before evaluated.'.format(path))
+            continue
+        bleu = evaluator.evaluate(**config.dev)
+        if best_bleu is None or bleu >= best_bleu:
+            best_bleu = bleu
+            if not tf.gfile.Exists(best_dir):
+                tf.gfile.MakeDirs(best_dir)
+            for fname in tf.gfile.Glob(os.path.join(best_dir, 'model*')):
+                tf.gfile.Remove(fname)
+            for fname in tf.gfile.Glob(path + '.*'):
+                tf.gfile.Copy(fname, os.path.join(best_dir, os.path.basename(fname)), overwrite=True)
+            tf.train.update_checkpoint_state(best_dir, os.path.join(best_dir, os.path.basename(path)))
+            logging.info('Copy the best checkpoint {} to {}.'.format(path, best_dir))
+        with open(dev_report_path(config), 'a') as f:
+            f.write('{}\t{}\n'.format(path, bleu))
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='Evaluate checkpoints on the dev set while training with train.async_eval.')
     args = parser.parse_args()
     # Read config
     config = AttrDict(yaml.load(open(args.config)))
     # Logger
     logging.basicConfig(level=logging.INFO)
-    evaluator = Evaluator()
-    if config.test.frozen:
-        evaluator.init_from_frozen_graphdef(config)
+    if args.watch:
+        watch_checkpoints(config)
     else:
-        evaluator.init_from_config(config)
-    for attr in config.test:
-        if attr.startswith('set'):
-            evaluator.evaluate(config.test.batch_size, **config.test[attr])
+        evaluator = Evaluator()
+        if config.test.frozen:
+            evaluator.init_from_frozen_graphdef(config)
+        else:
+            evaluator.init_from_config(config)
+        for attr in config.test:
+            if attr.startswith('set'):
+                evaluator.evaluate(config.test.batch_size, **config.test[attr])
     logging.info("Done")
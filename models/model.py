@@ -1,3 +1,4 @@
+import functools
 import random
 from collections import defaultdict
 from tensorflow.python.ops import init_ops
@@ -20,6 +21,20 @@ class Model(object):
         self.src_pls = tuple(src_pls)
         self.dst_pls = tuple(dst_pls)
 
+        # Cached top-k ids and probabilities of a teacher model at the target positions (see teacher_topk.py).
+        self._use_teacher_topk = bool(self._config.train and self._config.train.teacher_topk_path)
+        if self._use_teacher_topk:
+            teacher_ids_pls = []
+            teacher_probs_pls = []
+            for i, device in enumerate(self._devices):
+                with tf.device(device):
+                    teacher_ids_pls.append(tf.placeholder(dtype=tf.int32, shape=[None, None, None],
+                                                          name='teacher_ids_pl_{}'.format(i)))
+                    teacher_probs_pls.append(tf.placeholder(dtype=tf.float32, shape=[None, None, None],
+                                                            name='teacher_probs_pl_{}'.format(i)))
+            self.teacher_ids_pls = tuple(teacher_ids_pls)
+            self.teacher_probs_pls = tuple(teacher_probs_pls)
+
         self.encoder_scope = self._config.encoder_scope or 'encoder'
         self.decoder_scope = self._config.decoder_scope or 'decoder'
 
@@ -34,6 +49,16 @@ class Model(object):
         self._use_cache = True
         self._use_daisy_chain_getter = True
 
+        # Optional (expensive) summaries: 'attention' for attention images, 'grads_norm' for gradient norms.
+        self._summaries = set(self._config.train.summaries or []) if self._config.train else set()
+
+        # Compute in float16 with float32 variables in training.
+        self._mixed_precision = bool(self._config.train and self._config.train.mixed_precision)
+
+    def compute_dtype(self, is_training):
+        """The dtype of activations."""
+        return tf.float16 if is_training and self._mixed_precision else tf.float32
+
     def prepare_shared_weights(self):
 
         partitions = self._config.num_shards or 16
@@ -92,8 +117,26 @@ class Model(object):
         else:
             raise Exception('Unknown optimizer: {}.'.format(self._config.train.optimizer))
 
+        if self._config.train.ps_hosts:
+            # Workers aggregate their gradients through the parameter servers in each step.
+            num_workers = len(self._config.train.worker_hosts)
+            self._optimizer = tf.train.SyncReplicasOptimizer(self._optimizer,
+                                                             replicas_to_aggregate=num_workers,
+                                                             total_num_replicas=num_workers)
+
         tf.summary.scalar('learning_rate', self.learning_rate)
 
+        if self._mixed_precision:
+            if self._config.train.ps_hosts:
+                raise Exception('Mixed precision is not supported in distributed training.')
+            # Dynamic loss scaling: the scale is halved when gradients overflow and doubled after 2000 steps
+            # without overflow.
+            self.loss_scale = tf.get_variable(name='loss_scale', shape=[], trainable=False,
+                                              initializer=tf.constant_initializer(2.0 ** 15))
+            self._loss_scale_good_steps = tf.get_variable(name='loss_scale_good_steps', dtype=tf.int64, shape=[],
+                                                          trainable=False, initializer=tf.zeros_initializer)
+            tf.summary.scalar('loss_scale', self.loss_scale)
+
     def build_train_model(self, test=True, teacher_model=None, reuse=None):
         """Build model for training. """
         logging.info('Build train model.')
@@ -131,8 +174,17 @@ class Model(object):
                     return chosen_device
                 return device
 
+            def mixed_precision_getter(getter, *args, **kwargs):
+                """Get a float32 variable for float16 computation, cached in the daisy chain."""
+                if self._use_daisy_chain_getter:
+                    getter = functools.partial(daisy_chain_getter, getter)
+                return float32_variable_storage_getter(getter, *args, **kwargs)
+
             device_setter = balanced_device_setter
-            custom_getter = daisy_chain_getter if self._use_daisy_chain_getter else None
+            if self._mixed_precision:
+                custom_getter = mixed_precision_getter
+            else:
+                custom_getter = daisy_chain_getter if self._use_daisy_chain_getter else None
 
             with tf.variable_scope(tf.get_variable_scope(),
                                    initializer=self._initializer,
@@ -152,8 +204,22 @@ class Model(object):
                             _, teacher_probs = teacher_model.test_loss(teacher_decoder_output,
                                                                        Y,
                                                                        reuse=i > 0 or None)
-                        self.train_output(decoder_output, Y, teacher_probs=teacher_probs, reuse=i > 0 or None)
-
+                        if self._config.train.teacher_topk:
+                            # Only the top-k teacher probabilities are kept as targets.
+                            teacher_topk_probs, teacher_topk_ids = tf.nn.top_k(teacher_probs,
+                                                                               k=self._config.train.teacher_topk)
+                            teacher_topk = (teacher_topk_ids, tf.stop_gradient(teacher_topk_probs))
+                            self.train_output(decoder_output, Y, teacher_probs=None, reuse=i > 0 or None,
+                                              teacher_topk=teacher_topk)
+                        else:
+                            self.train_output(decoder_output, Y, teacher_probs=teacher_probs, reuse=i > 0 or None)
+
+                    elif self._use_teacher_topk:
+                        # Cached predictions may be longer than the target batch of this tower.
+                        length = tf.shape(Y)[1]
+                        teacher_topk = (self.teacher_ids_pls[i][:, :length], self.teacher_probs_pls[i][:, :length])
+                        self.train_output(decoder_output, Y, teacher_probs=None, reuse=i > 0 or None,
+                                          teacher_topk=teacher_topk)
                     else:
                         self.train_output(decoder_output, Y, teacher_probs=None, reuse=i > 0 or None)
 
@@ -195,11 +261,32 @@ class Model(object):
             self.predictions = tf.concat(preds_list, axis=0, name='predictions')
             self.loss_sum = tf.identity(loss_sum, name='loss_sum')
 
+    def build_teacher_topk_model(self, k, reuse=None):
+        """Build model for the top-k predictions at the target positions, which are targets of distillation."""
+        logging.info('Build teacher top-k model.')
+        with tf.variable_scope(tf.get_variable_scope(), reuse=reuse):
+            ids_list, probs_list = [], []
+            for i, (X, Y, device) in enumerate(zip(self.src_pls, self.dst_pls, self._devices)):
+                with tf.device(device):
+                    logging.info('Build model on %s.' % device)
+                    enc_output = self.encoder(X, is_training=False, reuse=i > 0 or None)
+                    dec_output = self.decoder(shift_right(Y), enc_output, is_training=False, reuse=i > 0 or None)
+                    _, probs = self.test_loss(dec_output, Y, reuse=i > 0 or None)
+                    probs, ids = tf.nn.top_k(probs, k=k)
+                    ids_list.append(ids)
+                    probs_list.append(probs)
+            self.topk_ids = tf.concat(ids_list, axis=0, name='topk_ids')
+            self.topk_probs = tf.concat(probs_list, axis=0, name='topk_probs')
+
     def register_loss(self, name, loss):
         self.losses[name].append(loss)
         # Filter out variables of the teacher model.
         vars = [v for v in tf.trainable_variables() if not v.name.startswith('teacher')]
-        grads_and_vars = self._optimizer.compute_gradients(loss, vars)
+        if self._mixed_precision:
+            # Scale the loss to keep small gradients from underflow in float16, they are unscaled in get_train_op.
+            grads_and_vars = self._optimizer.compute_gradients(loss * self.loss_scale, vars)
+        else:
+            grads_and_vars = self._optimizer.compute_gradients(loss, vars)
         grads_and_vars_not_none = []
         for g, v in grads_and_vars:
             # Avoid exception when g is None.
@@ -210,9 +297,10 @@ class Model(object):
         self.grads_and_vars[name].append(grads_and_vars_not_none)
 
         if not tf.get_variable_scope().reuse:
-            grads_norm = tf.global_norm([gv[0] for gv in grads_and_vars_not_none])
             tf.summary.scalar(name.format(name), loss)
-            tf.summary.scalar('{}_grads_norm'.format(name), grads_norm)
+            if 'grads_norm' in self._summaries:
+                grads_norm = tf.global_norm([gv[0] for gv in grads_and_vars_not_none])
+                tf.summary.scalar('{}_grads_norm'.format(name), grads_norm)
 
     def get_train_op(self, increase_global_step=True, name=None):
         global_step = self.global_step if increase_global_step else None
@@ -235,6 +323,30 @@ class Model(object):
             summed_grads_and_vars = [(summed_grads_and_vars[v], v) for v in summed_grads_and_vars]
             grads_and_vars = summed_grads_and_vars
 
+        if self._mixed_precision:
+            grads_and_vars = [(g / self.loss_scale, v) for g, v in grads_and_vars]
+
+        # Gradients accumulation
+        accumulate_steps = self._config.train.accumulate_steps or 1
+        if accumulate_steps > 1:
+            if self._config.train.ps_hosts:
+                raise Exception('Gradients accumulation is not supported in distributed training.')
+            accumulators = []
+            for _, v in grads_and_vars:
+                with tf.colocate_with(v):
+                    accumulators.append(tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                                                    trainable=False,
+                                                    name=v.op.name + '/accumulator'))
+            # Run the accumulate_op for the first accumulate_steps - 1 micro-batches and the train_op for the last.
+            self.accumulate_op = tf.group(*[acc.assign_add(g) for acc, (g, _) in zip(accumulators, grads_and_vars)])
+            with tf.control_dependencies([self.accumulate_op]):
+                grads_and_vars = [(acc.read_value() / accumulate_steps, v)
+                                  for acc, (_, v) in zip(accumulators, grads_and_vars)]
+
+        if self._mixed_precision:
+            # Skip the update if any gradient overflows.
+            grads_finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g, _ in grads_and_vars])
+
         # Gradients clipping
         if self._config.train.grads_clip:
             grads, _ = tf.clip_by_global_norm([g for g, _ in grads_and_vars],
@@ -243,10 +355,34 @@ class Model(object):
             grads_and_vars = list(zip(grads, vars))
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(update_ops):
-            train_op = self._optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+            if self._mixed_precision:
+                train_op = tf.cond(grads_finite,
+                                   lambda: tf.group(self._optimizer.apply_gradients(grads_and_vars,
+                                                                                    global_step=global_step)),
+                                   tf.no_op)
+                with tf.control_dependencies([train_op]):
+                    train_op = self.update_loss_scale(grads_finite)
+            else:
+                train_op = self._optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+
+        if accumulate_steps > 1:
+            # Reset accumulators after applying gradients.
+            with tf.control_dependencies([train_op]):
+                train_op = tf.group(*[acc.assign(tf.zeros_like(acc)) for acc in accumulators])
 
         return train_op, avg_loss
 
+    def update_loss_scale(self, grads_finite):
+        """Halve the loss scale if gradients overflow, or double it after 2000 steps without overflow."""
+        zero = tf.zeros_like(self._loss_scale_good_steps)
+        good_steps = tf.where(grads_finite, self._loss_scale_good_steps + 1, zero)
+        increase = good_steps >= 2000
+        loss_scale = tf.where(grads_finite,
+                              tf.where(increase, self.loss_scale * 2, self.loss_scale),
+                              tf.maximum(self.loss_scale / 2, 1.0))
+        return tf.group(self.loss_scale.assign(loss_scale),
+                        self._loss_scale_good_steps.assign(tf.where(increase, zero, good_steps)))
+
     def encoder(self, encoder_input, is_training, reuse):
         """Encoder."""
         with tf.variable_scope(self.encoder_scope, reuse=reuse):
@@ -262,6 +398,18 @@ class Model(object):
         with tf.variable_scope(self.decoder_scope, reuse=reuse):
             return self.decoder_with_caching_impl(decoder_input, decoder_cache, encoder_output, is_training)
 
+    def decoder_memory(self, encoder_output, beam_size, reuse):
+        """Prepare the memory attended by the incremental decoder, once per search."""
+        with tf.variable_scope(self.decoder_scope, reuse=reuse):
+            return self.decoder_memory_impl(encoder_output, beam_size)
+
+    def init_decoder_cache(self, batch_size):
+        """
+        The initial cache fed to decoder_with_caching. Sub classes may override this and return any nested
+        structure of tensors, as long as the first dimension of each tensor is batch_size.
+        """
+        return tf.zeros([batch_size, 0, self._config.num_blocks, self._config.hidden_units])
+
     def beam_search(self, encoder_output, use_cache, reuse):
         """Beam search in graph."""
         beam_size, batch_size = self._config.test.beam_size, tf.shape(encoder_output)[0]
@@ -283,8 +431,7 @@ class Model(object):
             """
             bias = tf.to_float(bias)
             b = tf.constant([0.0] + [-inf] * (beam_size - 1))
-            b = tf.tile(b[None, :], multiples=[batch_size * beam_size, 1])
-            return scores * (1 - bias[:, None]) + b * bias[:, None]
+            return scores * (1 - bias[:, None]) + b[None, :] * bias[:, None]
 
         def get_bias_preds(preds, bias):
             """
@@ -299,34 +446,52 @@ class Model(object):
             bias = tf.to_int32(bias)
             return preds * (1 - bias[:, None]) + bias[:, None] * 3
 
+        def get_best_preds(preds, scores):
+            """
+            Select the hypothesis with the highest score for each sentence.
+            Args:
+                preds: A int array with shape [batch_size * beam_size, length].
+                scores: A real value array with shape [batch_size * beam_size].
+
+            Returns:
+                A int array with shape [batch_size, length].
+            """
+            scores = tf.reshape(scores, shape=[-1, beam_size])
+            max_indices = tf.to_int32(tf.argmax(scores, axis=-1))  # [batch_size]
+            max_indices += tf.range(tf.shape(scores)[0]) * beam_size
+            return tf.gather(preds, indices=max_indices)
+
         # Prepare beam search inputs.
-        # [batch_size, 1, *, hidden_units]
-        encoder_output = encoder_output[:, None, :, :]
-        # [batch_size, beam_size, *, hidden_units]
-        encoder_output = tf.tile(encoder_output, multiples=[1, beam_size, 1, 1])
-        encoder_output = tf.reshape(encoder_output, [batch_size * beam_size, -1, encoder_output.get_shape()[-1].value])
+        if use_cache:
+            cache = self.init_decoder_cache(batch_size * beam_size)
+            # Computed once outside of the loop.
+            memory = self.decoder_memory(encoder_output, beam_size, reuse=reuse)
+        else:
+            cache = tf.zeros([0, 0, 0, 0])
+            # [batch_size * beam_size, *, hidden_units]
+            memory = tile_to_beam(encoder_output, beam_size)
         # [[<S>, <S>, ..., <S>]], shape: [batch_size * beam_size, 1]
         preds = tf.ones([batch_size * beam_size, 1], dtype=tf.int32) * 2
         scores = tf.constant([0.0] + [-inf] * (beam_size - 1), dtype=tf.float32)  # [beam_size]
         scores = tf.tile(scores, multiples=[batch_size])  # [batch_size * beam_size]
         lengths = tf.zeros([batch_size * beam_size], dtype=tf.float32)
         bias = tf.zeros_like(scores, dtype=tf.bool)
+        # Indices of sentences still in the loop, and the final predictions (padded by </S>) of the others.
+        alive = tf.range(batch_size)
+        final_preds = tf.ones([batch_size, 1], dtype=tf.int32) * 3
 
-        if use_cache:
-            cache = tf.zeros([batch_size * beam_size, 0, self._config.num_blocks, self._config.hidden_units])
-        else:
-            cache = tf.zeros([0, 0, 0, 0])
-
-        def step(i, bias, preds, scores, lengths, cache):
+        def step(i, alive, bias, preds, scores, lengths, cache, memory, final_preds):
             # Where are we.
             i += 1
+            # Number of sentences still in the loop.
+            n = tf.shape(alive)[0]
 
             # Call decoder and get predictions.
             if use_cache:
                 decoder_output, cache = \
-                    self.decoder_with_caching(preds, cache, encoder_output, is_training=False, reuse=reuse)
+                    self.decoder_with_caching(preds, cache, memory, is_training=False, reuse=reuse)
             else:
-                decoder_output = self.decoder(preds, encoder_output, is_training=False, reuse=reuse)
+                decoder_output = self.decoder(preds, memory, is_training=False, reuse=reuse)
 
             _, next_preds, next_scores = self.test_output(decoder_output, reuse=reuse)
 
@@ -334,20 +499,20 @@ class Model(object):
             next_scores = get_bias_scores(next_scores, bias)
 
             # Update scores.
-            scores = scores[:, None] + next_scores  # [batch_size * beam_size, beam_size]
-            scores = tf.reshape(scores, shape=[batch_size, beam_size ** 2])  # [batch_size, beam_size * beam_size]
+            scores = scores[:, None] + next_scores  # [n * beam_size, beam_size]
+            scores = tf.reshape(scores, shape=[n, beam_size ** 2])  # [n, beam_size * beam_size]
 
             # LP scores.
-            lengths = lengths[:, None] + tf.to_float(tf.not_equal(next_preds, 3))  # [batch_size * beam_size, beam_size]
-            lengths = tf.reshape(lengths, shape=[batch_size, beam_size ** 2])  # [batch_size, beam_size * beam_size]
+            lengths = lengths[:, None] + tf.to_float(tf.not_equal(next_preds, 3))  # [n * beam_size, beam_size]
+            lengths = tf.reshape(lengths, shape=[n, beam_size ** 2])  # [n, beam_size * beam_size]
             lp = tf.pow((5 + lengths) / (5 + 1), self._config.test.lp_alpha)  # Length penalty
             lp_scores = scores / lp  # following GNMT
 
             # Pruning
             _, k_indices = tf.nn.top_k(lp_scores, k=beam_size)
-            base_indices = tf.reshape(tf.tile(tf.range(batch_size)[:, None], multiples=[1, beam_size]), shape=[-1])
+            base_indices = tf.reshape(tf.tile(tf.range(n)[:, None], multiples=[1, beam_size]), shape=[-1])
             base_indices *= beam_size ** 2
-            k_indices = base_indices + tf.reshape(k_indices, shape=[-1])  # [batch_size * beam_size]
+            k_indices = base_indices + tf.reshape(k_indices, shape=[-1])  # [n * beam_size]
 
             # Update lengths.
             lengths = tf.reshape(lengths, [-1])
@@ -361,15 +526,46 @@ class Model(object):
             next_preds = tf.gather(tf.reshape(next_preds, shape=[-1]), indices=k_indices)
             preds = tf.gather(preds, indices=k_indices / beam_size)
             if use_cache:
-                cache = tf.gather(cache, indices=k_indices / beam_size)
-            preds = tf.concat((preds, next_preds[:, None]), axis=1)  # [batch_size * beam_size, i]
+                cache = nest.map_structure(lambda t: tf.gather(t, indices=k_indices / beam_size), cache)
+            preds = tf.concat((preds, next_preds[:, None]), axis=1)  # [n * beam_size, i]
+            final_preds = tf.concat((final_preds, tf.ones([batch_size, 1], dtype=tf.int32) * 3), axis=1)
 
             # Whether sequences finished.
             bias = tf.equal(preds[:, -1], 3)  # </S>?
 
-            return i, bias, preds, scores, lengths, cache
+            if self._config.test.compact_finished:
+                # Move sentences whose hypotheses are all finished out of the loop.
+                finished = tf.reduce_all(tf.reshape(bias, [n, beam_size]), axis=1)
 
-        def not_finished(i, bias, preds, scores, lengths, cache):
+                def compact():
+                    finished_indices = tf.to_int32(tf.where(finished)[:, 0])
+                    best_preds = tf.gather(get_best_preds(preds, scores), finished_indices)
+                    new_final_preds = final_preds + tf.scatter_nd(tf.gather(alive, finished_indices)[:, None],
+                                                                  best_preds - 3,
+                                                                  tf.shape(final_preds))
+
+                    keep_indices = tf.to_int32(tf.where(tf.logical_not(finished))[:, 0])
+
+                    def gather_sentences(t):
+                        """Gather the rows of kept sentences, each sentence has k consecutive rows in t."""
+                        k = tf.shape(t)[0] // n
+                        indices = tf.reshape(keep_indices[:, None] * k + tf.range(k)[None, :], [-1])
+                        return tf.gather(t, indices)
+
+                    new_cache = nest.map_structure(gather_sentences, cache) if use_cache else cache
+                    return (tf.gather(alive, keep_indices), gather_sentences(bias), gather_sentences(preds),
+                            gather_sentences(scores), gather_sentences(lengths), new_cache,
+                            nest.map_structure(gather_sentences, memory), new_final_preds)
+
+                def keep():
+                    return alive, bias, preds, scores, lengths, cache, memory, final_preds
+
+                alive, bias, preds, scores, lengths, cache, memory, final_preds = \
+                    tf.cond(tf.reduce_any(finished), compact, keep)
+
+            return i, alive, bias, preds, scores, lengths, cache, memory, final_preds
+
+        def not_finished(i, alive, bias, preds, scores, lengths, cache, memory, final_preds):
             return tf.logical_and(
                 tf.reduce_any(tf.logical_not(bias)),
                 tf.less_equal(
@@ -378,27 +574,24 @@ class Model(object):
                 )
             )
 
-        i, bias, preds, scores, lengths, cache = \
+        i, alive, bias, preds, scores, lengths, cache, memory, final_preds = \
             tf.while_loop(cond=not_finished,
                           body=step,
-                          loop_vars=[0, bias, preds, scores, lengths, cache],
+                          loop_vars=[0, alive, bias, preds, scores, lengths, cache, memory, final_preds],
                           shape_invariants=[
                               tf.TensorShape([]),
                               tf.TensorShape([None]),
+                              tf.TensorShape([None]),
                               tf.TensorShape([None, None]),
                               tf.TensorShape([None]),
                               tf.TensorShape([None]),
-                              tf.TensorShape([None, None, None, None])],
+                              shape_invariants(cache),
+                              shape_invariants(memory, batch_only=True),
+                              tf.TensorShape([None, None])],
                           back_prop=False)
 
-        scores = tf.reshape(scores, shape=[batch_size, beam_size])
-        preds = tf.reshape(preds, shape=[batch_size, beam_size, -1])  # [batch_size, beam_size, max_length]
-
-        max_indices = tf.to_int32(tf.argmax(scores, axis=-1))  # [batch_size]
-        max_indices += tf.range(batch_size) * beam_size
-        preds = tf.reshape(preds, shape=[batch_size * beam_size, -1])
-
-        final_preds = tf.gather(preds, indices=max_indices)
+        # Sentences left in the loop.
+        final_preds += tf.scatter_nd(alive[:, None], get_best_preds(preds, scores) - 3, tf.shape(final_preds))
         final_preds = final_preds[:, 1:]  # remove <S> flag
         return final_preds
 
@@ -409,14 +602,18 @@ class Model(object):
         preds = tf.ones([batch_size, 1], dtype=tf.int32) * 2
         scores = tf.zeros([batch_size], dtype=tf.float32)
         finished = tf.zeros([batch_size], dtype=tf.bool)
-        cache = tf.zeros([batch_size, 0, self._config.num_blocks, self._config.hidden_units])
+        cache = self.init_decoder_cache(batch_size)
+        memory = self.decoder_memory(encoder_output, 1, reuse=reuse)
+        # Indices of sentences still in the loop, and the final predictions (padded by </S>) of the others.
+        alive = tf.range(batch_size)
+        final_preds = tf.ones([batch_size, 1], dtype=tf.int32) * 3
 
-        def step(i, finished, preds, scores, cache):
+        def step(i, alive, finished, preds, scores, cache, memory, final_preds):
             # Where are we.
             i += 1
 
             # Call decoder and get predictions.
-            decoder_output, cache = self.decoder_with_caching(preds, cache, encoder_output, is_training=False, reuse=reuse)
+            decoder_output, cache = self.decoder_with_caching(preds, cache, memory, is_training=False, reuse=reuse)
             _, next_preds, next_scores = self.test_output(decoder_output, reuse=reuse)
             next_preds = next_preds[:, None, 0]
             next_scores = next_scores[:, 0]
@@ -424,14 +621,37 @@ class Model(object):
             # Update.
             scores = scores + next_scores
             preds = tf.concat([preds, next_preds], axis=1)
+            final_preds = tf.concat((final_preds, tf.ones([batch_size, 1], dtype=tf.int32) * 3), axis=1)
 
             # Whether sequences finished.
             has_eos = tf.equal(next_preds[:, 0], 3)
             finished = tf.logical_or(finished, has_eos)
 
-            return i, finished, preds, scores, cache
+            if self._config.test.compact_finished:
+                # Move finished sentences out of the loop.
+                def compact():
+                    finished_indices = tf.to_int32(tf.where(finished)[:, 0])
+                    new_final_preds = final_preds + tf.scatter_nd(tf.gather(alive, finished_indices)[:, None],
+                                                                  tf.gather(preds, finished_indices) - 3,
+                                                                  tf.shape(final_preds))
+                    keep_indices = tf.to_int32(tf.where(tf.logical_not(finished))[:, 0])
 
-        def not_finished(i, finished, preds, scores, cache):
+                    def gather_sentences(t):
+                        return tf.gather(t, keep_indices)
+
+                    return (gather_sentences(alive), gather_sentences(finished), gather_sentences(preds),
+                            gather_sentences(scores), nest.map_structure(gather_sentences, cache),
+                            nest.map_structure(gather_sentences, memory), new_final_preds)
+
+                def keep():
+                    return alive, finished, preds, scores, cache, memory, final_preds
+
+                alive, finished, preds, scores, cache, memory, final_preds = \
+                    tf.cond(tf.reduce_any(finished), compact, keep)
+
+            return i, alive, finished, preds, scores, cache, memory, final_preds
+
+        def not_finished(i, alive, finished, preds, scores, cache, memory, final_preds):
             return tf.logical_and(
                 tf.reduce_any(tf.logical_not(finished)),
                 tf.less_equal(
@@ -440,20 +660,25 @@ class Model(object):
                 )
             )
 
-        i, finished, preds, scores, cache = \
+        i, alive, finished, preds, scores, cache, memory, final_preds = \
             tf.while_loop(cond=not_finished,
                           body=step,
-                          loop_vars=[0, finished, preds, scores, cache],
+                          loop_vars=[0, alive, finished, preds, scores, cache, memory, final_preds],
                           shape_invariants=[
                               tf.TensorShape([]),
                               tf.TensorShape([None]),
+                              tf.TensorShape([None]),
                               tf.TensorShape([None, None]),
                               tf.TensorShape([None]),
-                              tf.TensorShape([None, None, None, None])],
+                              shape_invariants(cache),
+                              shape_invariants(memory, batch_only=True),
+                              tf.TensorShape([None, None])],
                           back_prop=False)
 
-        preds = preds[:, 1:]  # remove <S> flag
-        return preds
+        # Sentences left in the loop.
+        final_preds += tf.scatter_nd(alive[:, None], preds - 3, tf.shape(final_preds))
+        final_preds = final_preds[:, 1:]  # remove <S> flag
+        return final_preds
 
     def test_output(self, decoder_output, reuse):
         """During test, we only need the last prediction at each time."""
@@ -472,33 +697,72 @@ class Model(object):
             logits = dense(decoder_output, self._config.dst_vocab_size, use_bias=False,
                            kernel=self._dst_softmax, name="decoder", reuse=None)
             mask = tf.to_float(tf.not_equal(Y, 0))
-            labels = tf.one_hot(Y, depth=self._config.dst_vocab_size)
-            loss = tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=labels)
+            loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=Y)
             loss_sum = tf.reduce_sum(loss * mask)
             probs = tf.nn.softmax(logits)
         return loss_sum, probs
 
-    def train_output(self, decoder_output, Y, teacher_probs, reuse):
-        """Calculate loss and accuracy."""
+    def train_output(self, decoder_output, Y, teacher_probs, reuse, teacher_topk=None):
+        """
+        Calculate loss and accuracy.
+        The loss is computed against the teacher probabilities, or the top-k (ids, probabilities) of the teacher
+        if either is given.
+        """
+        # Logits and loss are computed in float32.
+        decoder_output = tf.cast(decoder_output, tf.float32)
+        distill = teacher_probs is not None or teacher_topk is not None
         with tf.variable_scope(self.decoder_scope, reuse=reuse):
-            logits = dense(decoder_output, self._config.dst_vocab_size, use_bias=False,
-                           kernel=self._dst_softmax, name='decoder', reuse=None)
-            preds = tf.to_int32(tf.argmax(logits, axis=-1))
-            mask = tf.to_float(tf.not_equal(Y, 0))
-
-            # Token-level accuracy
-            acc = tf.reduce_sum(tf.to_float(tf.equal(preds, Y)) * mask) / tf.reduce_sum(mask)
-            if not tf.get_variable_scope().reuse:
-                tf.summary.scalar('accuracy', acc)
-
-            if teacher_probs is not None:
-                # Knowledge distillation
-                loss = tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=teacher_probs)
+            if not distill and self._config.train.softmax_samples:
+                # Sampled softmax avoids the projection to the full vocabulary. Words are sampled from a log-uniform
+                # distribution, which fits vocabularies sorted by frequency (see vocab.py).
+                if self._config.train.label_smoothing and not reuse:
+                    logging.warning('Label smoothing is not applied to the sampled softmax loss.')
+                loss = tf.nn.sampled_softmax_loss(weights=self._dst_softmax,
+                                                  biases=tf.zeros([self._config.dst_vocab_size]),
+                                                  labels=tf.reshape(Y, [-1, 1]),
+                                                  inputs=tf.reshape(decoder_output, [-1, self._config.hidden_units]),
+                                                  num_sampled=self._config.train.softmax_samples,
+                                                  num_classes=self._config.dst_vocab_size)
+                loss = tf.reshape(loss, tf.shape(Y))
+                # Predictions are unknown without the full projection.
+                preds = None
+            elif not distill and self._config.train.loss_chunk_size:
+                # Smoothed loss fused with the projection, computed in chunks of positions.
+                loss, preds = chunked_smoothing_cross_entropy(
+                    tf.reshape(decoder_output, [-1, self._config.hidden_units]),
+                    kernel=self._dst_softmax,
+                    labels=tf.reshape(Y, [-1]),
+                    vocab_size=self._config.dst_vocab_size,
+                    confidence=1 - self._config.train.label_smoothing,
+                    chunk_size=self._config.train.loss_chunk_size)
+                loss = tf.reshape(loss, tf.shape(Y))
+                preds = tf.reshape(preds, tf.shape(Y))
             else:
+                logits = dense(decoder_output, self._config.dst_vocab_size, use_bias=False,
+                               kernel=self._dst_softmax, name='decoder', reuse=None)
+                preds = tf.to_int32(tf.argmax(logits, axis=-1))
                 # Smoothed loss
                 loss = common_layers.smoothing_cross_entropy(logits=logits, labels=Y,
                                                              vocab_size=self._config.dst_vocab_size,
                                                              confidence=1 - self._config.train.label_smoothing)
+                if distill:
+                    if teacher_probs is not None:
+                        # Knowledge distillation
+                        kd_loss = tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=teacher_probs)
+                    else:
+                        # Knowledge distillation with sparse teacher distributions
+                        kd_loss = topk_cross_entropy(logits, *teacher_topk)
+                    # The distillation loss may be mixed with the smoothed loss of the gold targets.
+                    kd_weight = 1.0 if self._config.train.kd_weight is None else self._config.train.kd_weight
+                    loss = kd_loss if kd_weight == 1.0 else kd_weight * kd_loss + (1 - kd_weight) * loss
+            mask = tf.to_float(tf.not_equal(Y, 0))
+
+            # Token-level accuracy
+            if preds is not None:
+                acc = tf.reduce_sum(tf.to_float(tf.equal(preds, Y)) * mask) / tf.reduce_sum(mask)
+                if not tf.get_variable_scope().reuse:
+                    tf.summary.scalar('accuracy', acc)
+
             loss = tf.reduce_sum(loss * mask) / tf.reduce_sum(mask)
 
             self.register_loss('ml_loss', loss)
@@ -533,11 +797,25 @@ class Model(object):
         This is an interface leave to be implemented by sub classes.
         Args:
             decoder_input: A Tensor with shape [batch_size, dst_length]
-            decoder_cache: A Tensor with shape [batch_size, *, *, num_hidden]
-            encoder_output: A Tensor with shape [batch_size, src_length, num_hidden]
+            decoder_cache: The cache returned by the previous step (see init_decoder_cache)
+            encoder_output: The memory returned by decoder_memory_impl
             is_training: A boolean.
 
         Returns: A Tensor with shape [batch_size, dst_length, num_hidden]
 
         """
         raise NotImplementedError()
+
+    def decoder_memory_impl(self, encoder_output, beam_size):
+        """
+        Sub classes may override this to compute things that do not change during decoding (e.g. keys and values
+        of the encoder-decoder attention) in advance, and to share them among the hypotheses in a beam.
+        By default the encoder output is tiled beam_size times and used directly.
+        Args:
+            encoder_output: A Tensor with shape [batch_size, src_length, num_hidden]
+            beam_size: An integer. The decoder input has batch_size * beam_size rows.
+
+        Returns: A nested structure of tensors, which is passed to decoder_with_caching_impl as encoder_output.
+
+        """
+        return tile_to_beam(encoder_output, beam_size)
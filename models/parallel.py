@@ -28,6 +28,7 @@ class PTransformer(Transformer):
     def decoder_impl(self, decoder_input, encoder_output, is_training):
         attention_dropout_rate = self._config.attention_dropout_rate if is_training else 0.0
         residual_dropout_rate = self._config.residual_dropout_rate if is_training else 0.0
+        dtype = self.compute_dtype(is_training)
 
         num_parallel = self._config.num_parallel
         padded_decoder_input = pad_begin(decoder_input, num_parallel - 1)
@@ -37,6 +38,7 @@ class PTransformer(Transformer):
 
         encoder_padding = tf.equal(tf.reduce_sum(tf.abs(encoder_output), axis=-1), 0.0)
         encoder_attention_bias = common_attention.attention_bias_ignore_padding(encoder_padding)
+        encoder_attention_bias = cast_attention_bias(encoder_attention_bias, dtype)
         decoder_output = embedding(padded_decoder_input,
                                    vocab_size=self._config.dst_vocab_size,
                                    dense_size=self._config.hidden_units,
@@ -45,6 +47,7 @@ class PTransformer(Transformer):
                                    name="dst_embedding")
         # Positional Encoding
         decoder_output = common_attention.add_timing_signal_1d(decoder_output)
+        decoder_output = tf.cast(decoder_output, dtype)
 
         # Dropout
         decoder_output = tf.layers.dropout(decoder_output,
@@ -52,6 +55,7 @@ class PTransformer(Transformer):
                                            training=is_training)
         # Bias for preventing peeping later information
         self_attention_bias = decoder_self_attention_bias(tf.shape(decoder_output)[1], self._config.num_parallel)
+        self_attention_bias = cast_attention_bias(self_attention_bias, dtype)
         # Blocks
         for i in range(self._config.num_blocks):
             with tf.variable_scope("block_{}".format(i)):
@@ -67,7 +71,7 @@ class PTransformer(Transformer):
                                               dropout_rate=attention_dropout_rate,
                                               output_depth=self._config.hidden_units,
                                               name="decoder_self_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Multihead Attention (vanilla attention)
@@ -82,7 +86,7 @@ class PTransformer(Transformer):
                                               num_heads=self._config.num_heads,
                                               dropout_rate=attention_dropout_rate,
                                               name="decoder_vanilla_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Position-wise Feed Forward
@@ -141,7 +145,7 @@ class PTransformer(Transformer):
                                               num_queries=num_parallel,
                                               output_depth=self._config.hidden_units,
                                               name="decoder_self_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Multihead Attention (vanilla attention)
@@ -157,7 +161,7 @@ class PTransformer(Transformer):
                                               dropout_rate=attention_dropout_rate,
                                               num_queries=num_parallel,
                                               name="decoder_vanilla_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Position-wise Feed Forward
@@ -616,27 +620,67 @@ class PTransformer(Transformer):
     #         probs = tf.nn.softmax(logits)
     #     return loss_sum, probs
 
-    def train_output(self, decoder_output, Y, teacher_probs, reuse):
-        """Calculate loss and accuracy."""
+    def train_output(self, decoder_output, Y, teacher_probs, reuse, teacher_topk=None):
+        """
+        Calculate loss and accuracy.
+        The loss is computed against the teacher probabilities, or the top-k (ids, probabilities) of the teacher
+        if either is given.
+        """
+        # Logits and loss are computed in float32.
+        decoder_output = tf.cast(decoder_output, tf.float32)
+        distill = teacher_probs is not None or teacher_topk is not None
         with tf.variable_scope(self.decoder_scope, reuse=reuse):
-            logits = dense(decoder_output, self._config.dst_vocab_size, use_bias=False,
-                           kernel=self._dst_softmax, name='decoder', reuse=None)
-            preds = tf.to_int32(tf.argmax(logits, axis=-1))
-            mask = tf.to_float(tf.not_equal(Y, 0))
-
-            # Token-level accuracy
-            acc = tf.reduce_sum(tf.to_float(tf.equal(preds, Y)) * mask) / tf.reduce_sum(mask)
-            if not tf.get_variable_scope().reuse:
-                tf.summary.scalar('accuracy', acc)
-
-            if teacher_probs is not None:
-                # Knowledge distillation
-                loss = tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=teacher_probs)
+            if not distill and self._config.train.softmax_samples:
+                # Sampled softmax avoids the projection to the full vocabulary. Words are sampled from a log-uniform
+                # distribution, which fits vocabularies sorted by frequency (see vocab.py).
+                if self._config.train.label_smoothing and not reuse:
+                    logging.warning('Label smoothing is not applied to the sampled softmax loss.')
+                loss = tf.nn.sampled_softmax_loss(weights=self._dst_softmax,
+                                                  biases=tf.zeros([self._config.dst_vocab_size]),
+                                                  labels=tf.reshape(Y, [-1, 1]),
+                                                  inputs=tf.reshape(decoder_output, [-1, self._config.hidden_units]),
+                                                  num_sampled=self._config.train.softmax_samples,
+                                                  num_classes=self._config.dst_vocab_size)
+                loss = tf.reshape(loss, tf.shape(Y))
+                # Predictions are unknown without the full projection.
+                preds = None
+            elif not distill and self._config.train.loss_chunk_size:
+                # Smoothed loss fused with the projection, computed in chunks of positions.
+                loss, preds = chunked_smoothing_cross_entropy(
+                    tf.reshape(decoder_output, [-1, self._config.hidden_units]),
+                    kernel=self._dst_softmax,
+                    labels=tf.reshape(Y, [-1]),
+                    vocab_size=self._config.dst_vocab_size,
+                    confidence=1 - self._config.train.label_smoothing,
+                    chunk_size=self._config.train.loss_chunk_size)
+                loss = tf.reshape(loss, tf.shape(Y))
+                preds = tf.reshape(preds, tf.shape(Y))
             else:
+                logits = dense(decoder_output, self._config.dst_vocab_size, use_bias=False,
+                               kernel=self._dst_softmax, name='decoder', reuse=None)
+                preds = tf.to_int32(tf.argmax(logits, axis=-1))
                 # Smoothed loss
                 loss = common_layers.smoothing_cross_entropy(logits=logits, labels=Y,
                                                              vocab_size=self._config.dst_vocab_size,
                                                              confidence=1 - self._config.train.label_smoothing)
+                if distill:
+                    if teacher_probs is not None:
+                        # Knowledge distillation
+                        kd_loss = tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=teacher_probs)
+                    else:
+                        # Knowledge distillation with sparse teacher distributions
+                        kd_loss = topk_cross_entropy(logits, *teacher_topk)
+                    # The distillation loss may be mixed with the smoothed loss of the gold targets.
+                    kd_weight = 1.0 if self._config.train.kd_weight is None else self._config.train.kd_weight
+                    loss = kd_loss if kd_weight == 1.0 else kd_weight * kd_loss + (1 - kd_weight) * loss
+            mask = tf.to_float(tf.not_equal(Y, 0))
+
+            # Token-level accuracy
+            if preds is not None:
+                acc = tf.reduce_sum(tf.to_float(tf.equal(preds, Y)) * mask) / tf.reduce_sum(mask)
+                if not tf.get_variable_scope().reuse:
+                    tf.summary.scalar('accuracy', acc)
+
             loss = tf.reduce_sum(loss * mask) / tf.reduce_sum(mask)
 
             self.register_loss('ml_loss', loss)
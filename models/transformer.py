@@ -18,10 +18,12 @@ class Transformer(Model):
 
         attention_dropout_rate = self._config.attention_dropout_rate if is_training else 0.0
         residual_dropout_rate = self._config.residual_dropout_rate if is_training else 0.0
+        dtype = self.compute_dtype(is_training)
 
         # Mask
         encoder_padding = tf.equal(encoder_input, 0)
         encoder_attention_bias = common_attention.attention_bias_ignore_padding(encoder_padding)
+        encoder_attention_bias = cast_attention_bias(encoder_attention_bias, dtype)
         # encoder_attention_bias = tf.tile(encoder_attention_bias,
         #                                  [1, self._config.num_heads, tf.shape(encoder_attention_bias)[-1], 1])
 
@@ -34,6 +36,7 @@ class Transformer(Model):
                                    name="src_embedding")
         # Add positional signal
         encoder_output = common_attention.add_timing_signal_1d(encoder_output)
+        encoder_output = tf.cast(encoder_output, dtype)
         # Dropout
         encoder_output = tf.layers.dropout(encoder_output,
                                            rate=residual_dropout_rate,
@@ -54,7 +57,7 @@ class Transformer(Model):
                                               num_heads=self._config.num_heads,
                                               dropout_rate=attention_dropout_rate,
                                               name='encoder_self_attention',
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Feed Forward
@@ -66,16 +69,18 @@ class Transformer(Model):
                                               activation=self._ff_activation),
                                           dropout_rate=residual_dropout_rate)
         # Mask padding part to zeros.
-        encoder_output *= tf.expand_dims(1.0 - tf.to_float(encoder_padding), axis=-1)
+        encoder_output *= tf.expand_dims(1.0 - tf.cast(encoder_padding, dtype), axis=-1)
         return encoder_output
 
     def decoder_impl(self, decoder_input, encoder_output, is_training):
 
         attention_dropout_rate = self._config.attention_dropout_rate if is_training else 0.0
         residual_dropout_rate = self._config.residual_dropout_rate if is_training else 0.0
+        dtype = self.compute_dtype(is_training)
 
         encoder_padding = tf.equal(tf.reduce_sum(tf.abs(encoder_output), axis=-1), 0.0)
         encoder_attention_bias = common_attention.attention_bias_ignore_padding(encoder_padding)
+        encoder_attention_bias = cast_attention_bias(encoder_attention_bias, dtype)
         # encoder_attention_bias = tf.tile(encoder_attention_bias,
         #                                  [1, self._config.num_heads, tf.shape(encoder_attention_bias)[-1], 1])
 
@@ -87,12 +92,14 @@ class Transformer(Model):
                                    name="dst_embedding")
         # Positional Encoding
         decoder_output = common_attention.add_timing_signal_1d(decoder_output)
+        decoder_output = tf.cast(decoder_output, dtype)
         # Dropout
         decoder_output = tf.layers.dropout(decoder_output,
                                            rate=residual_dropout_rate,
                                            training=is_training)
         # Bias for preventing peeping later information
         self_attention_bias = common_attention.attention_bias_lower_triangle(tf.shape(decoder_input)[1])
+        self_attention_bias = cast_attention_bias(self_attention_bias, dtype)
 
         # Blocks
         for i in range(self._config.num_blocks):
@@ -109,7 +116,7 @@ class Transformer(Model):
                                               dropout_rate=attention_dropout_rate,
                                               output_depth=self._config.hidden_units,
                                               name="decoder_self_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Multihead Attention (vanilla attention)
@@ -124,7 +131,7 @@ class Transformer(Model):
                                               num_heads=self._config.num_heads,
                                               dropout_rate=attention_dropout_rate,
                                               name="decoder_vanilla_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Feed Forward
@@ -137,8 +144,41 @@ class Transformer(Model):
                                           dropout_rate=residual_dropout_rate)
         return decoder_output
 
+    def decoder_memory_impl(self, encoder_output, beam_size):
+        if not self._config.test.kv_cache:
+            return super(Transformer, self).decoder_memory_impl(encoder_output, beam_size)
+        # The attention bias and the keys and values of the vanilla attention in each block.
+        # They are not tiled, all hypotheses in a beam attend to the same memory.
+        encoder_padding = tf.equal(tf.reduce_sum(tf.abs(encoder_output), axis=-1), 0.0)
+        memory = {'encoder_output': encoder_output,
+                  'bias': common_attention.attention_bias_ignore_padding(encoder_padding)}
+        for i in range(self._config.num_blocks):
+            with tf.variable_scope("block_{}".format(i)):
+                memory['block_{}'.format(i)] = multihead_attention_memory(
+                    encoder_output,
+                    total_key_depth=self._config.hidden_units,
+                    total_value_depth=self._config.hidden_units,
+                    num_heads=self._config.num_heads,
+                    name="decoder_vanilla_attention")
+        return memory
+
+    def init_decoder_cache(self, batch_size):
+        if not self._config.test.kv_cache:
+            return super(Transformer, self).init_decoder_cache(batch_size)
+        # Keys and values of the self-attention in each block, with shape [batch_size, num_heads, 0, depth].
+        depth = self._config.hidden_units // self._config.num_heads
+        cache = {}
+        for i in range(self._config.num_blocks):
+            cache['block_{}'.format(i)] = {
+                'k': tf.zeros([batch_size, self._config.num_heads, 0, depth]),
+                'v': tf.zeros([batch_size, self._config.num_heads, 0, depth])}
+        return cache
+
     def decoder_with_caching_impl(self, decoder_input, decoder_cache, encoder_output, is_training):
 
+        if self._config.test.kv_cache:
+            return self.decoder_with_kv_caching_impl(decoder_input, decoder_cache, encoder_output, is_training)
+
         attention_dropout_rate = self._config.attention_dropout_rate if is_training else 0.0
         residual_dropout_rate = self._config.residual_dropout_rate if is_training else 0.0
 
@@ -178,7 +218,7 @@ class Transformer(Model):
                                               num_queries=1,
                                               output_depth=self._config.hidden_units,
                                               name="decoder_self_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Multihead Attention (vanilla attention)
@@ -194,7 +234,7 @@ class Transformer(Model):
                                               dropout_rate=attention_dropout_rate,
                                               num_queries=1,
                                               name="decoder_vanilla_attention",
-                                              summaries=True),
+                                              summaries='attention' in self._summaries),
                                           dropout_rate=residual_dropout_rate)
 
                 # Feed Forward
@@ -212,3 +252,77 @@ class Transformer(Model):
         new_cache = tf.concat(new_cache, axis=2)  # [batch_size, n_step, num_blocks, num_hidden]
 
         return decoder_output, new_cache
+
+    def decoder_with_kv_caching_impl(self, decoder_input, decoder_cache, decoder_memory, is_training):
+        """
+        Incremental decoder that caches the projected keys and values of the self-attention, so each step only
+        computes the newest position. Keys and values of the encoder output come from decoder_memory_impl.
+        """
+
+        attention_dropout_rate = self._config.attention_dropout_rate if is_training else 0.0
+        residual_dropout_rate = self._config.residual_dropout_rate if is_training else 0.0
+
+        decoder_output = embedding(decoder_input,
+                                   vocab_size=self._config.dst_vocab_size,
+                                   dense_size=self._config.hidden_units,
+                                   kernel=self._dst_embedding,
+                                   multiplier=self._config.hidden_units ** 0.5 if self._config.scale_embedding else 1.0,
+                                   name="dst_embedding")
+        # Positional Encoding
+        decoder_output = common_attention.add_timing_signal_1d(decoder_output)
+        # Previous positions are already in the cache.
+        decoder_output = decoder_output[:, -1:, :]
+        # Dropout
+        decoder_output = tf.layers.dropout(decoder_output,
+                                           rate=residual_dropout_rate,
+                                           training=is_training)
+
+        new_cache = {}
+
+        # Blocks
+        for i in range(self._config.num_blocks):
+            layer_cache = dict(decoder_cache['block_{}'.format(i)])
+            with tf.variable_scope("block_{}".format(i)):
+                # Multihead Attention (self-attention)
+                decoder_output = residual(decoder_output,
+                                          multihead_attention(
+                                              query_antecedent=decoder_output,
+                                              memory_antecedent=None,
+                                              bias=None,
+                                              total_key_depth=self._config.hidden_units,
+                                              total_value_depth=self._config.hidden_units,
+                                              num_heads=self._config.num_heads,
+                                              dropout_rate=attention_dropout_rate,
+                                              output_depth=self._config.hidden_units,
+                                              cache=layer_cache,
+                                              name="decoder_self_attention",
+                                              summaries='attention' in self._summaries),
+                                          dropout_rate=residual_dropout_rate)
+
+                # Multihead Attention (vanilla attention)
+                decoder_output = residual(decoder_output,
+                                          multihead_attention(
+                                              query_antecedent=decoder_output,
+                                              memory_antecedent=decoder_memory['encoder_output'],
+                                              bias=decoder_memory['bias'],
+                                              total_key_depth=self._config.hidden_units,
+                                              total_value_depth=self._config.hidden_units,
+                                              output_depth=self._config.hidden_units,
+                                              num_heads=self._config.num_heads,
+                                              dropout_rate=attention_dropout_rate,
+                                              cache=decoder_memory['block_{}'.format(i)],
+                                              name="decoder_vanilla_attention",
+                                              summaries='attention' in self._summaries),
+                                          dropout_rate=residual_dropout_rate)
+
+                # Feed Forward
+                decoder_output = residual(decoder_output,
+                                          ff_hidden(
+                                              decoder_output,
+                                              hidden_size=self._config.ff_hidden_units,
+                                              output_size=self._config.hidden_units,
+                                              activation=self._ff_activation),
+                                          dropout_rate=residual_dropout_rate)
+            new_cache['block_{}'.format(i)] = layer_cache
+
+        return decoder_output, new_cache
@@ -0,0 +1,181 @@
+import logging
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from argparse import ArgumentParser
+
+import yaml
+
+from evaluate import Evaluator
+from utils import AttrDict
+
+
+class PendingSentence(object):
+    """A sentence waiting for translation."""
+
+    def __init__(self, words):
+        self.words = words
+        self.time = time.time()
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchTranslator(object):
+    """
+    Translate sentences submitted by concurrent clients in shared batches.
+    A batch is formed around the oldest pending sentence with the pending sentences closest to it in length, once
+    there are enough pending sentences for a full batch (test.batch_size sentences or test.tokens_per_batch tokens,
+    padding included), or the oldest one has waited for `max_wait` seconds.
+    """
+
+    def __init__(self, evaluator, max_wait=0.05):
+        self._evaluator = evaluator
+        self._batch_size = evaluator.config.test.batch_size
+        self._tokens_per_batch = evaluator.config.test.tokens_per_batch
+        self._num_gpus = evaluator.config.test.num_gpus
+        self._max_wait = max_wait
+        self._pending = []
+        self._cond = threading.Condition()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def translate(self, sents):
+        """Translate tokenized sentences, blocks until all of them are translated."""
+        pending = [PendingSentence(sent.split()) for sent in sents]
+        with self._cond:
+            self._pending.extend(pending)
+            self._cond.notify()
+        for p in pending:
+            p.done.wait()
+            if p.error is not None:
+                raise p.error
+        return [p.output for p in pending]
+
+    def _full(self):
+        if len(self._pending) >= self._batch_size:
+            return True
+        max_len = max(len(p.words) for p in self._pending) + 1  # </S>
+        return bool(self._tokens_per_batch) and len(self._pending) * max_len >= self._tokens_per_batch
+
+    def _take_batch(self):
+        """Remove a batch from the pending sentences: the oldest one and those closest to it in length."""
+        pending = sorted(self._pending, key=lambda p: len(p.words))
+        lo = pending.index(self._pending[0])
+        hi = lo + 1
+        length = len(pending[lo].words)
+        max_len = length + 1  # </S>
+        while hi - lo < self._batch_size and (lo > 0 or hi < len(pending)):
+            # Of the neighbours in length order, the closer one in length to the oldest sentence is added.
+            take_left = hi == len(pending) or \
+                lo > 0 and length - len(pending[lo - 1].words) <= len(pending[hi].words) - length
+            candidate = pending[lo - 1] if take_left else pending[hi]
+            new_max_len = max(max_len, len(candidate.words) + 1)
+            if self._tokens_per_batch and (hi - lo + 1) * new_max_len > self._tokens_per_batch:
+                break
+            max_len = new_max_len
+            if take_left:
+                lo -= 1
+            else:
+                hi += 1
+        batch = pending[lo: hi]
+        taken = set(id(p) for p in batch)
+        self._pending = [p for p in self._pending if id(p) not in taken]
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                while not self._full():
+                    remaining = self._pending[0].time + self._max_wait - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+            self._translate_batch(batch)
+
+    def _translate_batch(self, batch):
+        start = time.time()
+        try:
+            sents = [p.words for p in batch]
+            # We ensure batch size not small than gpu number by padding redundant samples.
+            sents += sents[-1:] * (self._num_gpus - len(sents))
+            X = self._evaluator.data_reader.create_batch(sents, o='src')
+            Y = self._evaluator.beam_search(X)[:len(batch)]
+            for p, output in zip(batch, self._evaluator.data_reader.indices_to_words(Y)):
+                # Remove BPE flag, if have.
+                p.output = re.sub(r'(@@ )|(@@ ?$)', '', output)
+        except Exception as e:
+            logging.exception('Failed to translate a batch.')
+            for p in batch:
+                p.error = e
+        for p in batch:
+            p.done.set()
+        logging.info('{0} sentences (max length {1}) translated in {2:.4f} seconds, waited {3:.4f} seconds.'.
+                     format(len(batch), max(len(p.words) for p in batch), time.time() - start,
+                            start - min(p.time for p in batch)))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(config, host='localhost', port=8080, max_wait=0.05):
+    """
+    Serve translations over HTTP. A POST request carries tokenized source sentences, one per line in utf-8, and is
+    answered with their translations, one per line. Sentences of concurrent requests are translated in shared
+    batches (see BatchTranslator).
+    """
+    evaluator = Evaluator()
+    if config.test.frozen:
+        evaluator.init_from_frozen_graphdef(config)
+    else:
+        evaluator.init_from_config(config)
+    translator = BatchTranslator(evaluator, max_wait)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.getheader('content-length', 0))).decode('utf-8')
+            # Split on '\n' only, as lines of a file are read for translation, so that the translations are aligned
+            # with the lines. Unicode line breaks such as u'\u2028' are taken as spaces.
+            lines = body.split(u'\n')
+            if lines[-1] == u'':
+                lines.pop()
+            try:
+                outputs = translator.translate(lines)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            response = u''.join(output + u'\n' for output in outputs).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logging.info('Serve translations on {}:{}.'.format(host, port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('--host', dest='host', default='localhost')
+    parser.add_argument('--port', dest='port', type=int, default=8080)
+    parser.add_argument('--max_wait', dest='max_wait', type=float, default=0.05,
+                        help='Max seconds a sentence waits for other sentences to be batched with.')
+    args = parser.parse_args()
+    # Read config
+    config = AttrDict(yaml.load(open(args.config)))
+    logging.basicConfig(level=logging.INFO)
+    serve(config, args.host, args.port, args.max_wait)
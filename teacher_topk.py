@@ -0,0 +1,98 @@
+import logging
+from argparse import ArgumentParser
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from models import *
+from utils import AttrDict, BinaryCorpusWriter, DataReader, expand_feed_dict
+
+
+def teacher_topk(config, teacher_config, k, batch_size):
+    """Caches the top-k predictions of a teacher model over the training corpus for distillation.
+
+    Args:
+      config: The config of the student model, whose training corpus is predicted by the teacher. The teacher and
+        the student should share vocabularies.
+      teacher_config: The config of the teacher model.
+      k: An int. Number of predictions at each target position.
+      batch_size: An int. Number of sentences predicted at a time.
+
+    Writes the ids and probabilities of the predictions at the target positions (including </S>) of each training
+    sentence pair to binary corpora (see utils.BinaryCorpus) `train.teacher_topk_path`.ids and
+    `train.teacher_topk_path`.probs. Sentence pairs exceeding `train.max_length` get no predictions.
+    """
+    data_reader = DataReader(config)
+    model = eval(teacher_config.model)(teacher_config, teacher_config.test.num_gpus)
+    model.build_teacher_topk_model(k)
+
+    sess_config = tf.ConfigProto()
+    sess_config.gpu_options.allow_growth = True
+    sess_config.allow_soft_placement = True
+    sess = tf.Session(config=sess_config)
+    tf.train.Saver().restore(sess, tf.train.latest_checkpoint(teacher_config.model_dir))
+
+    prefix = config.train.teacher_topk_path
+    ids_writer = BinaryCorpusWriter(prefix + '.ids', np.int32, width=k)
+    probs_writer = BinaryCorpusWriter(prefix + '.probs', np.float16, width=k)
+    # The number of towers which a batch is split over.
+    num_towers = len(model.src_pls)
+
+    def flush(pairs):
+        batch = [p for p in pairs if p is not None]
+        if batch:
+            # Ensure each tower at least get one sample.
+            batch += batch[-1:] * (num_towers - len(batch))
+            X = data_reader.pad_batch([src_sent for src_sent, _ in batch])
+            Y = data_reader.pad_batch([dst_sent for _, dst_sent in batch])
+            ids, probs = sess.run([model.topk_ids, model.topk_probs],
+                                  feed_dict=expand_feed_dict({model.src_pls: X, model.dst_pls: Y}))
+        j = 0
+        for p in pairs:
+            if p is None:
+                ids_writer.append(np.zeros([0, k]))
+                probs_writer.append(np.zeros([0, k]))
+            else:
+                length = len(p[1]) + 1  # </S>
+                ids_writer.append(ids[j, :length])
+                probs_writer.append(probs[j, :length])
+                j += 1
+
+    if config.train.src_bin_path and config.train.dst_bin_path:
+        pairs = data_reader.get_binary_training_pairs()
+    else:
+        pairs = data_reader.get_text_training_pairs()
+    cache, num_sents = [], 0
+    try:
+        for src_sent, dst_sent in pairs:
+            if len(src_sent) > config.train.max_length or len(dst_sent) > config.train.max_length:
+                cache.append(None)
+            else:
+                cache.append((src_sent, dst_sent))
+                num_sents += 1
+            if num_sents >= batch_size:
+                flush(cache)
+                cache, num_sents = [], 0
+                logging.info('Predicted %d sentences.' % len(ids_writer))
+        flush(cache)
+    finally:
+        ids_writer.close()
+        probs_writer.close()
+        pairs.close()
+    logging.info('Teacher top-k predictions: {}\tsentences: {}'.format(prefix, len(ids_writer)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-t', '--teacher_config', dest='teacher_config')
+    parser.add_argument('-k', dest='k', type=int, default=8)
+    parser.add_argument('-b', '--batch_size', dest='batch_size', type=int, default=128)
+    args = parser.parse_args()
+    # Read config
+    config = AttrDict(yaml.load(open(args.config)))
+    teacher_config = AttrDict(yaml.load(open(args.teacher_config)))
+    logging.basicConfig(level=logging.INFO)
+    teacher_topk(config, teacher_config, args.k, args.batch_size)
+    logging.info("Done")
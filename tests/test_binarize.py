@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from binarize import binarize
+from utils import BinaryCorpus
+
+
+class BinarizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unicode_line_breaks(self):
+        # u'\x85' and '\r' are line breaks for unicode.splitlines, but not for DataReader.
+        path = os.path.join(self.tmp_dir, 'train.src')
+        with open(path, 'w') as f:
+            f.write(u'a b\x85c\rd\ne c\n'.encode('utf8'))
+        prefix = os.path.join(self.tmp_dir, 'train.src.bin')
+        binarize(path, {u'a': 4, u'b': 5, u'c': 6, u'd': 7}, prefix)
+
+        corpus = BinaryCorpus(prefix)
+        self.assertEqual(len(corpus), 2)
+        self.assertEqual(len(corpus), len(open(path).readlines()))
+        self.assertEqual(list(corpus[0]), [4, 5, 6, 7])
+        self.assertEqual(list(corpus[1]), [1, 6])
+
+
+if __name__ == '__main__':
+    unittest.main()
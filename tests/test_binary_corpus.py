@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils import BinaryCorpus
+
+
+class BinaryCorpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = os.path.join(tempfile.mkdtemp(), 'corpus')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.prefix))
+
+    def test_scalars(self):
+        BinaryCorpus.write([[4, 5], [], [6]], self.prefix)
+        corpus = BinaryCorpus(self.prefix)
+        self.assertEqual(corpus.tokens.shape, (3,))
+        self.assertEqual([list(corpus[i]) for i in range(len(corpus))], [[4, 5], [], [6]])
+
+    def test_rows_of_width_one(self):
+        BinaryCorpus.write([np.ones([2, 1]), np.zeros([0, 1])], self.prefix, np.float16, width=1)
+        corpus = BinaryCorpus(self.prefix, np.float16)
+        self.assertEqual(corpus.width, 1)
+        self.assertEqual(corpus.tokens.shape, (2, 1))
+        self.assertEqual(corpus[1].shape, (0, 1))
+
+    def test_empty_rows(self):
+        BinaryCorpus.write([np.zeros([0, 4]), np.zeros([0, 4])], self.prefix, width=4)
+        corpus = BinaryCorpus(self.prefix)
+        self.assertEqual(len(corpus), 2)
+        self.assertEqual(corpus.tokens.shape, (0, 4))
+
+    def test_wrong_width(self):
+        with self.assertRaises(AssertionError):
+            BinaryCorpus.write([np.zeros([2, 3])], self.prefix, width=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from itertools import product
+
+import numpy as np
+import tensorflow as tf
+
+from models import Transformer
+from utils import AttrDict
+
+
+class DecodingTest(tf.test.TestCase):
+    """Predictions of a tiny random Transformer are the same with and without the decoding optimizations."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def config(beam_size, kv_cache, compact_finished):
+        return AttrDict(model='Transformer', src_vocab_size=8, dst_vocab_size=8, hidden_units=16, num_blocks=2,
+                        num_heads=2, ff_hidden_units=32, ff_activation='relu', scale_embedding=True,
+                        tie_embedding_and_softmax=True, tie_embeddings=False, num_shards=1,
+                        attention_dropout_rate=0.0, residual_dropout_rate=0.0,
+                        test=dict(beam_size=beam_size, kv_cache=kv_cache, compact_finished=compact_finished,
+                                  max_target_length=12, lp_alpha=0.6, num_gpus=0))
+
+    def decode(self, X, checkpoint, beam_size, kv_cache, compact_finished, seed=None):
+        """Initialize the variables by `seed` and save them to `checkpoint` if given, or restore them from it."""
+        with tf.Graph().as_default():
+            if seed is not None:
+                tf.set_random_seed(seed)
+            model = Transformer(self.config(beam_size, kv_cache, compact_finished), 0)
+            model.build_test_model()
+            saver = tf.train.Saver()
+            with tf.Session() as sess:
+                if seed is not None:
+                    sess.run(tf.global_variables_initializer())
+                    saver.save(sess, checkpoint)
+                else:
+                    saver.restore(sess, checkpoint)
+                return sess.run(model.predictions, feed_dict={model.src_pls[0]: X})
+
+    @staticmethod
+    def end_steps(preds):
+        """Steps at which the sentences end (the first </S>), or the length of the predictions."""
+        is_eos = preds == 3
+        return np.where(is_eos.any(axis=1), is_eos.argmax(axis=1), preds.shape[1])
+
+    def test_predictions_match(self):
+        rng = np.random.RandomState(0)
+        X = rng.randint(4, 8, [6, 5]).astype(np.int32)
+        X[1, 3:] = 0
+        X[4, 2:] = 0
+        checkpoint = os.path.join(self.tmp_dir, 'model')
+        for beam_size in [1, 4]:
+            # Find initial weights with which sentences end at different steps, so that the optimized loops move
+            # finished sentences out and scatter their predictions back.
+            for seed in range(20):
+                expected = self.decode(X, checkpoint, beam_size, False, False, seed=seed)
+                ends = self.end_steps(expected)
+                if len(set(ends)) > 2 and ends.min() < expected.shape[1]:
+                    break
+            else:
+                self.fail('No initial weights make sentences end at different steps.')
+            for kv_cache, compact_finished in product([False, True], [False, True]):
+                actual = self.decode(X, checkpoint, beam_size, kv_cache, compact_finished)
+                self.assertAllEqual(actual, expected,
+                                    msg='beam_size={}, kv_cache={}, compact_finished={}'.format(
+                                        beam_size, kv_cache, compact_finished))
+
+
+if __name__ == '__main__':
+    tf.test.main()
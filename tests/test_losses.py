@@ -0,0 +1,59 @@
+import numpy as np
+import tensorflow as tf
+
+from third_party.tensor2tensor import common_layers
+from utils import chunked_smoothing_cross_entropy, topk_cross_entropy
+
+
+class ChunkedSmoothingCrossEntropyTest(tf.test.TestCase):
+
+    def test_matches_dense(self):
+        n, hidden_size, vocab_size, confidence = 15, 8, 11, 0.9
+        rng = np.random.RandomState(0)
+        inputs = tf.constant(rng.randn(n, hidden_size), tf.float32)
+        kernel = tf.constant(rng.randn(vocab_size, hidden_size), tf.float32)
+        labels = tf.constant(rng.randint(0, vocab_size, n), tf.int32)
+        # Weights make the gradients of the losses differ among positions.
+        weights = tf.constant(rng.rand(n), tf.float32)
+
+        logits = tf.matmul(inputs, kernel, transpose_b=True)
+        dense_loss = common_layers.smoothing_cross_entropy(logits, labels, vocab_size, confidence)
+        dense_preds = tf.argmax(logits, axis=-1)
+        dense_grads = tf.gradients(tf.reduce_sum(dense_loss * weights), [inputs, kernel])
+
+        with self.test_session() as sess:
+            expected = sess.run([dense_loss, dense_preds] + dense_grads)
+            # Chunk sizes of 4 and 7 do not divide the number of positions.
+            for chunk_size in [1, 4, 7, 15, 32]:
+                loss, preds = chunked_smoothing_cross_entropy(inputs, kernel, labels, vocab_size, confidence,
+                                                              chunk_size)
+                grads = tf.gradients(tf.reduce_sum(loss * weights), [inputs, kernel])
+                actual = sess.run([loss, preds] + grads)
+                self.assertAllClose(actual[0], expected[0], rtol=1e-5, atol=1e-5)
+                self.assertAllEqual(actual[1], expected[1])
+                self.assertAllClose(actual[2], expected[2], rtol=1e-5, atol=1e-5)
+                self.assertAllClose(actual[3], expected[3], rtol=1e-5, atol=1e-5)
+
+
+class TopkCrossEntropyTest(tf.test.TestCase):
+
+    def test_matches_dense(self):
+        batch_size, length, vocab_size, k = 2, 3, 7, 4
+        rng = np.random.RandomState(0)
+        logits = rng.randn(batch_size, length, vocab_size).astype(np.float32)
+        ids = np.array([[rng.permutation(vocab_size)[:k] for _ in range(length)] for _ in range(batch_size)], np.int32)
+        probs = rng.rand(batch_size, length, k).astype(np.float32)
+        # Dense targets with the renormalized probabilities at the top-k ids.
+        targets = np.zeros_like(logits)
+        for b in range(batch_size):
+            for t in range(length):
+                targets[b, t, ids[b, t]] = probs[b, t] / probs[b, t].sum()
+
+        with self.test_session() as sess:
+            expected = sess.run(tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=targets))
+            actual = sess.run(topk_cross_entropy(tf.constant(logits), tf.constant(ids), tf.constant(probs)))
+        self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -2,37 +2,97 @@ import os
 import time
 import logging
 from argparse import ArgumentParser
+from itertools import count
 import tensorflow as tf
 import yaml
 
-from evaluate import Evaluator
+from evaluate import Evaluator, read_dev_reports
 from models import *
-from utils import DataReader, AttrDict, available_variables, expand_feed_dict
+from utils import DataReader, AttrDict, AsyncSaver, Prefetcher, available_variables, expand_feed_dict, \
+    balanced_partition
 
 
 class BreakLoopException(Exception):
     pass
 
 
-def train(config):
-    """Train a model with a config file."""
-    logger = logging.getLogger('')
-    data_reader = DataReader(config=config)
-    model = eval(config.model)(config=config, num_gpus=config.train.num_gpus)
-    model.build_train_model(test=config.train.eval_on_dev)
+def create_sync_session(target, sync_optimizer, is_chief, init_fn, config):
+    """
+    Create a session of a worker training with a SyncReplicasOptimizer. The chief worker initializes variables
+    (by `init_fn` after initializers) and starts the queue runner aggregating gradients, others wait for it.
+    """
+    session_manager = tf.train.SessionManager(
+        local_init_op=sync_optimizer.chief_init_op if is_chief else sync_optimizer.local_step_init_op,
+        ready_op=tf.report_uninitialized_variables(),
+        ready_for_local_init_op=sync_optimizer.ready_for_local_init_op,
+        recovery_wait_secs=5)
+    if is_chief:
+        sess = session_manager.prepare_session(target, init_op=tf.global_variables_initializer(),
+                                               init_fn=init_fn, config=config)
+        sess.run(sync_optimizer.get_init_tokens_op())
+        sync_optimizer.get_chief_queue_runner().create_threads(sess, daemon=True, start=True)
+    else:
+        sess = session_manager.wait_for_session(target, config=config)
+    return sess
+
 
-    train_op, loss_op = model.get_train_op(name=None)
-    global_saver = tf.train.Saver()
+def train(config, job_name='worker', task_index=0):
+    """
+    Train a model with a config file.
+    If train.ps_hosts is set, run the `task_index`-th task of the job (`ps` or `worker`) in the cluster.
+    Each worker trains on a shard of the training data.
+    """
+    logger = logging.getLogger('')
 
     sess_config = tf.ConfigProto()
     sess_config.gpu_options.allow_growth = True
     sess_config.allow_soft_placement = True
 
-    summary_writer = tf.summary.FileWriter(config.model_dir)
+    if config.train.ps_hosts:
+        cluster = tf.train.ClusterSpec({'ps': config.train.ps_hosts, 'worker': config.train.worker_hosts})
+        server = tf.train.Server(cluster, job_name=job_name, task_index=task_index, config=sess_config)
+        if job_name == 'ps':
+            logger.info('Parameter server {} started.'.format(task_index))
+            server.join()
+            return
+        # Place variables on the parameter servers.
+        device_setter = tf.train.replica_device_setter(worker_device='/job:worker/task:{}'.format(task_index),
+                                                       cluster=cluster)
+        num_workers = len(config.train.worker_hosts)
+    else:
+        server = None
+        device_setter = None
+        num_workers = 1
+    # The chief worker evaluates, saves models and writes summaries.
+    is_chief = task_index == 0
+    # Synchronous workers wait for the gradients of each other in each step, so they have to stop together: each
+    # cycles over its shard and stops at train.num_steps. train.num_epochs and train.toleration, which are checked
+    # by each worker alone, are not used.
+    distributed = server is not None
+    if distributed:
+        if config.train.num_steps is None:
+            raise Exception('train.num_steps is required in distributed training.')
+        logger.info('train.num_epochs and train.toleration are ignored in distributed training.')
+    # Saved models may be evaluated by another process (evaluate.py --watch) instead.
+    async_eval = config.train.eval_on_dev and config.train.async_eval
+    eval_on_dev = config.train.eval_on_dev and is_chief and not async_eval
 
-    with tf.Session(config=sess_config) as sess:
-        # Initialize all variables.
-        sess.run(tf.global_variables_initializer())
+    data_reader = DataReader(config=config, shard=task_index, num_shards=num_workers)
+    with tf.device(device_setter):
+        model = eval(config.model)(config=config, num_gpus=config.train.num_gpus)
+        model.build_train_model(test=eval_on_dev)
+
+        train_op, loss_op = model.get_train_op(name=None)
+        if config.train.async_save:
+            # Write checkpoints in background.
+            global_saver = AsyncSaver(max_to_keep=config.train.max_to_keep or 5,
+                                      max_pending=config.train.max_pending_saves or 1)
+        else:
+            global_saver = tf.train.Saver(max_to_keep=config.train.max_to_keep or 5)
+
+    summary_writer = tf.summary.FileWriter(config.model_dir) if is_chief else None
+
+    def init_fn(sess):
         # Reload variables from disk.
         if tf.train.latest_checkpoint(config.model_dir):
             available_vars = available_variables(config.model_dir)
@@ -46,33 +106,53 @@ def train(config):
         else:
             logger.info('Nothing to be reload from disk.')
 
+    if server is None:
+        sess = tf.Session(config=sess_config)
+        # Initialize all variables.
+        sess.run(tf.global_variables_initializer())
+        init_fn(sess)
+    else:
+        sess = create_sync_session(server.target, model._optimizer, is_chief, init_fn, sess_config)
+
+    with sess:
         evaluator = Evaluator()
-        evaluator.init_from_existed(model, sess, data_reader)
+        evaluator.init_from_existed(config, model, sess, data_reader)
 
-        global dev_bleu, toleration
-        dev_bleu = evaluator.evaluate(**config.dev) if config.train.eval_on_dev else 0
+        global dev_bleu, toleration, num_dev_reports
+        dev_bleu = evaluator.evaluate(**config.dev) if eval_on_dev else 0
         toleration = config.train.toleration
+        # Scores reported before this run only set the best BLEU to beat.
+        dev_reports = read_dev_reports(config) if async_eval else []
+        dev_bleu = max([dev_bleu] + [bleu for _, bleu in dev_reports])
+        num_dev_reports = len(dev_reports)
 
-        def train_one_step(batch, loss_op, train_op):
-            feed_dict = expand_feed_dict({model.src_pls: batch[0], model.dst_pls: batch[1]})
-            step, lr, loss, _ = sess.run(
-                [model.global_step, model.learning_rate,
-                 loss_op, train_op],
-                feed_dict=feed_dict)
-            if step % config.train.summary_freq == 0:
-                summary = sess.run(model.summary_op, feed_dict=feed_dict)
+        def train_one_step(batch, loss_op, train_op, summary=False):
+            partition = balanced_partition(batch[:2], len(model.src_pls)) if config.train.balance_towers else None
+            feed_dict = {model.src_pls: batch[0], model.dst_pls: batch[1]}
+            if config.train.teacher_topk_path:
+                # Cached teacher predictions (see teacher_topk.py).
+                feed_dict.update({model.teacher_ids_pls: batch[2], model.teacher_probs_pls: batch[3]})
+            feed_dict = expand_feed_dict(feed_dict, partition)
+            fetches = [model.global_step, model.learning_rate, loss_op, train_op]
+            if summary:
+                # Fetch summaries in the same run as the train op.
+                step, lr, loss, _, summary = sess.run(fetches + [model.summary_op], feed_dict=feed_dict)
                 summary_writer.add_summary(summary, global_step=step)
+            else:
+                step, lr, loss, _ = sess.run(fetches, feed_dict=feed_dict)
             return step, lr, loss
 
         def maybe_save_model():
-            global dev_bleu, toleration
+            global dev_bleu, toleration, num_dev_reports
 
             def save():
                 mp = config.model_dir + '/model_step_{}'.format(step)
                 global_saver.save(sess, mp)
                 logger.info('Save model in %s.' % mp)
 
-            if config.train.eval_on_dev:
+            if not is_chief:
+                return
+            if eval_on_dev:
                 new_dev_bleu = evaluator.evaluate(**config.dev)
                 if config.train.toleration is None:
                     save()
@@ -83,26 +163,63 @@ def train(config):
                         dev_bleu = new_dev_bleu
                     else:
                         toleration -= 1
+            elif async_eval:
+                save()
+                if config.train.toleration is not None:
+                    dev_reports = read_dev_reports(config)
+                    for _, new_dev_bleu in dev_reports[num_dev_reports:]:
+                        if new_dev_bleu >= dev_bleu:
+                            toleration = config.train.toleration
+                            dev_bleu = new_dev_bleu
+                        else:
+                            toleration -= 1
+                    num_dev_reports = len(dev_reports)
             else:
                 save()
 
         try:
             step = 0
-            for epoch in range(1, config.train.num_epochs+1):
-                for batch in data_reader.get_training_batches(epoches=1):
+            num_batches = 0
+            accumulate_steps = config.train.accumulate_steps or 1
+            # The global step fetched by a worker may lag behind other workers, so workers count their own steps
+            # to stop after the same number of steps.
+            num_steps_left = config.train.num_steps - sess.run(model.global_step) if distributed else None
+            for epoch in (count(1) if distributed else range(1, config.train.num_epochs+1)):
+                batches = data_reader.get_training_batches(epoches=1, first_epoch=epoch)
+                if config.train.prefetch_batches:
+                    # Prepare batches in background.
+                    batches = Prefetcher(lambda: data_reader.get_training_batches(epoches=1, first_epoch=epoch),
+                                         capacity=config.train.prefetch_batches,
+                                         use_process=config.train.prefetch_in_process)
+                for batch in batches:
+                    num_batches += 1
+                    if num_batches % accumulate_steps:
+                        # Accumulate gradients of micro-batches, which are applied with the last one.
+                        train_one_step(batch, loss_op, model.accumulate_op)
+                        continue
 
                     # Train normal instances.
                     start_time = time.time()
-                    step, lr, loss = train_one_step(batch, loss_op, train_op)
+                    # The step of this run is expected to be the next one.
+                    summary = is_chief and (step + 1) % config.train.summary_freq == 0
+                    step, lr, loss = train_one_step(batch, loss_op, train_op, summary)
                     logger.info(
                         'epoch: {0}\tstep: {1}\tlr: {2:.6f}\tloss: {3:.4f}\ttime: {4:.4f}'.
-                        format(epoch, step, lr, loss, time.time() - start_time))
+                        format(epoch, step, lr, loss, time.time() - start_time) +
+                        ('\tqueue_empty: {0:.4f}'.format(batches.empty_fraction)
+                         if isinstance(batches, Prefetcher) else ''))
                     # Save model
                     if config.train.save_freq > 0 \
                        and step > 0 \
                        and step % config.train.save_freq == 0:
                         maybe_save_model()
 
+                    if distributed:
+                        num_steps_left -= 1
+                        if num_steps_left <= 0:
+                            raise BreakLoopException("BreakLoop")
+                        continue
+
                     if config.train.num_steps is not None and step >= config.train.num_steps:
                         raise BreakLoopException("BreakLoop")
 
@@ -114,6 +231,9 @@ def train(config):
                     maybe_save_model()
         except BreakLoopException as e:
             logger.info(e)
+        finally:
+            if isinstance(global_saver, AsyncSaver):
+                global_saver.close()
 
         logger.info("Finish training.")
 
@@ -121,15 +241,21 @@ def train(config):
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('--job_name', dest='job_name', default='worker', choices=['ps', 'worker'])
+    parser.add_argument('--task_index', dest='task_index', type=int, default=0)
     args = parser.parse_args()
     # Read config
     config = AttrDict(yaml.load(open(args.config)))
     # Logger
     if not os.path.exists(config.model_dir):
         os.makedirs(config.model_dir)
-    logging.basicConfig(filename=config.model_dir + '/train.log', level=logging.INFO)
+    if (args.job_name, args.task_index) != ('worker', 0):
+        log_path = config.model_dir + '/train_{}_{}.log'.format(args.job_name, args.task_index)
+    else:
+        log_path = config.model_dir + '/train.log'
+    logging.basicConfig(filename=log_path, level=logging.INFO)
     console = logging.StreamHandler()
     console.setLevel(logging.INFO)
     logging.getLogger('').addHandler(console)
     # Train
-    train(config)
+    train(config, args.job_name, args.task_index)
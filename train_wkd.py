@@ -5,9 +5,10 @@ from argparse import ArgumentParser
 import tensorflow as tf
 import yaml
 
-from evaluate import Evaluator
+from evaluate import Evaluator, read_dev_reports
 from models import *
-from utils import DataReader, AttrDict, available_variables, expand_feed_dict
+from utils import DataReader, AttrDict, AsyncSaver, Prefetcher, available_variables, expand_feed_dict, \
+    balanced_partition
 
 
 class BreakLoopException(Exception):
@@ -36,10 +37,19 @@ def train(config, teacher_config):
     model = eval(config.model)(config=config, num_gpus=config.train.num_gpus)
     with tf.variable_scope('teacher'):
         teacher_model = eval(teacher_config.model)(config=teacher_config, num_gpus=0)
-    model.build_train_model(test=config.train.eval_on_dev, teacher_model=teacher_model)
+    # Saved models may be evaluated by another process (evaluate.py --watch) instead.
+    async_eval = config.train.eval_on_dev and config.train.async_eval
+    eval_on_dev = config.train.eval_on_dev and not async_eval
+    model.build_train_model(test=eval_on_dev, teacher_model=teacher_model)
 
     train_op, loss_op = model.get_train_op(name=None)
-    global_saver = tf.train.Saver([v for v in tf.global_variables() if not v.name.startswith('teacher')])
+    student_vars = [v for v in tf.global_variables() if not v.name.startswith('teacher')]
+    if config.train.async_save:
+        # Write checkpoints in background.
+        global_saver = AsyncSaver(student_vars, max_to_keep=config.train.max_to_keep or 5,
+                                  max_pending=config.train.max_pending_saves or 1)
+    else:
+        global_saver = tf.train.Saver(student_vars, max_to_keep=config.train.max_to_keep or 5)
 
     sess_config = tf.ConfigProto()
     sess_config.gpu_options.allow_growth = True
@@ -76,32 +86,37 @@ def train(config, teacher_config):
             logger.info('Nothing to be reload from disk.')
 
         evaluator = Evaluator()
-        evaluator.init_from_existed(model, sess, data_reader)
+        evaluator.init_from_existed(config, model, sess, data_reader)
 
-        global dev_bleu, toleration
-        dev_bleu = evaluator.evaluate(**config.dev) if config.train.eval_on_dev else 0
+        global dev_bleu, toleration, num_dev_reports
+        dev_bleu = evaluator.evaluate(**config.dev) if eval_on_dev else 0
         toleration = config.train.toleration
-
-        def train_one_step(batch, loss_op, train_op):
-            feed_dict = expand_feed_dict({model.src_pls: batch[0], model.dst_pls: batch[1]})
-            step, lr, loss, _ = sess.run(
-                [model.global_step, model.learning_rate,
-                 loss_op, train_op],
-                feed_dict=feed_dict)
-            if step % config.train.summary_freq == 0:
-                summary = sess.run(model.summary_op, feed_dict=feed_dict)
+        # Scores reported before this run only set the best BLEU to beat.
+        dev_reports = read_dev_reports(config) if async_eval else []
+        dev_bleu = max([dev_bleu] + [bleu for _, bleu in dev_reports])
+        num_dev_reports = len(dev_reports)
+
+        def train_one_step(batch, loss_op, train_op, summary=False):
+            partition = balanced_partition(batch, len(model.src_pls)) if config.train.balance_towers else None
+            feed_dict = expand_feed_dict({model.src_pls: batch[0], model.dst_pls: batch[1]}, partition)
+            fetches = [model.global_step, model.learning_rate, loss_op, train_op]
+            if summary:
+                # Fetch summaries in the same run as the train op.
+                step, lr, loss, _, summary = sess.run(fetches + [model.summary_op], feed_dict=feed_dict)
                 summary_writer.add_summary(summary, global_step=step)
+            else:
+                step, lr, loss, _ = sess.run(fetches, feed_dict=feed_dict)
             return step, lr, loss
 
         def maybe_save_model():
-            global dev_bleu, toleration
+            global dev_bleu, toleration, num_dev_reports
 
             def save():
                 mp = config.model_dir + '/model_step_{}'.format(step)
                 global_saver.save(sess, mp)
                 logger.info('Save model in %s.' % mp)
 
-            if config.train.eval_on_dev:
+            if eval_on_dev:
                 new_dev_bleu = evaluator.evaluate(**config.dev)
                 if config.train.toleration is None:
                     save()
@@ -112,20 +127,48 @@ def train(config, teacher_config):
                         dev_bleu = new_dev_bleu
                     else:
                         toleration -= 1
+            elif async_eval:
+                save()
+                if config.train.toleration is not None:
+                    dev_reports = read_dev_reports(config)
+                    for _, new_dev_bleu in dev_reports[num_dev_reports:]:
+                        if new_dev_bleu >= dev_bleu:
+                            toleration = config.train.toleration
+                            dev_bleu = new_dev_bleu
+                        else:
+                            toleration -= 1
+                    num_dev_reports = len(dev_reports)
             else:
                 save()
 
         try:
             step = 0
+            num_batches = 0
+            accumulate_steps = config.train.accumulate_steps or 1
             for epoch in range(1, config.train.num_epochs+1):
-                for batch in data_reader.get_training_batches(epoches=1):
+                batches = data_reader.get_training_batches(epoches=1, first_epoch=epoch)
+                if config.train.prefetch_batches:
+                    # Prepare batches in background.
+                    batches = Prefetcher(lambda: data_reader.get_training_batches(epoches=1, first_epoch=epoch),
+                                         capacity=config.train.prefetch_batches,
+                                         use_process=config.train.prefetch_in_process)
+                for batch in batches:
+                    num_batches += 1
+                    if num_batches % accumulate_steps:
+                        # Accumulate gradients of micro-batches, which are applied with the last one.
+                        train_one_step(batch, loss_op, model.accumulate_op)
+                        continue
 
                     # Train normal instances.
                     start_time = time.time()
-                    step, lr, loss = train_one_step(batch, loss_op, train_op)
+                    # The step of this run is expected to be the next one.
+                    summary = (step + 1) % config.train.summary_freq == 0
+                    step, lr, loss = train_one_step(batch, loss_op, train_op, summary)
                     logger.info(
                         'epoch: {0}\tstep: {1}\tlr: {2:.6f}\tloss: {3:.4f}\ttime: {4:.4f}'.
-                        format(epoch, step, lr, loss, time.time() - start_time))
+                        format(epoch, step, lr, loss, time.time() - start_time) +
+                        ('\tqueue_empty: {0:.4f}'.format(batches.empty_fraction)
+                         if isinstance(batches, Prefetcher) else ''))
                     # Save model
                     if config.train.save_freq > 0 \
                        and step > 0 \
@@ -143,6 +186,9 @@ def train(config, teacher_config):
                     maybe_save_model()
         except BreakLoopException as e:
             logger.info(e)
+        finally:
+            if isinstance(global_saver, AsyncSaver):
+                global_saver.close()
 
         logger.info("Finish training.")
 
@@ -1,16 +1,21 @@
 from __future__ import print_function
 
+import bisect
 import codecs
+import cPickle
 import logging
+import multiprocessing
 import os
-import time
-from itertools import izip
-from tempfile import mkstemp
+import threading
+from collections import OrderedDict
+from itertools import chain, count, izip
+from Queue import Empty, Full, Queue
 
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.framework as tff
 from tensorflow.python.layers import base as base_layer
+from tensorflow.python.util import nest
 
 from third_party.tensor2tensor import common_layers, common_attention
 common_layers.allow_defun = False
@@ -33,21 +38,88 @@ class AttrDict(dict):
         return self[item]
 
 
+class BinaryCorpus(object):
+    """
+    Sentences stored as int32 token indices in `{prefix}.bin`, indexed by the int64 offsets of sentences in
+    `{prefix}.idx.npy` (see binarize.py). The token file is memory-mapped.
+    Items of a sentence may also be rows of a fixed width and another dtype, e.g. the top-k predictions of a
+    teacher model at each target position (see teacher_topk.py). The index file starts with the width of the rows,
+    0 if items are scalars, followed by the offsets.
+    """
+
+    def __init__(self, prefix, dtype=np.int32):
+        index = np.load(prefix + '.idx.npy')
+        self.width, self.offsets = int(index[0]), index[1:]
+        assert len(self.offsets) > 0 and self.offsets[0] == 0, 'Bad index file, regenerate the corpus.'
+        shape = (self.offsets[-1], self.width) if self.width else (self.offsets[-1],)
+        if self.offsets[-1] > 0:
+            assert os.path.getsize(prefix + '.bin') == np.prod(shape) * np.dtype(dtype).itemsize
+            self.tokens = np.memmap(prefix + '.bin', dtype=dtype, mode='r', shape=shape)
+        else:
+            self.tokens = np.zeros(shape, dtype)  # An empty file can not be memory-mapped.
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]: self.offsets[i + 1]]
+
+    @staticmethod
+    def write(sents, prefix, dtype=np.int32, width=None):
+        """Write sentences (iterable of sequences of indices) in the binary format."""
+        writer = BinaryCorpusWriter(prefix, dtype, width)
+        try:
+            for sent in sents:
+                writer.append(sent)
+        finally:
+            writer.close()
+
+
+class BinaryCorpusWriter(object):
+    """
+    Append sentences to a binary corpus (see BinaryCorpus) one by one.
+    If `width` is given, items of the sentences are rows of `width` values.
+    """
+
+    def __init__(self, prefix, dtype=np.int32, width=None):
+        self._prefix = prefix
+        self._dtype = dtype
+        self._shape = (width,) if width else ()
+        self._file = open(prefix + '.bin', 'wb')
+        self._offsets = [0]
+
+    def append(self, sent):
+        sent = np.asarray(sent, dtype=self._dtype)
+        if len(sent) == 0:
+            sent = sent.reshape((0,) + self._shape)
+        assert sent.shape[1:] == self._shape, 'Expect items of shape {}, got {}.'.format(self._shape, sent.shape[1:])
+        sent.tofile(self._file)
+        self._offsets.append(self._offsets[-1] + len(sent))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def close(self):
+        self._file.close()
+        width = self._shape[0] if self._shape else 0
+        np.save(self._prefix + '.idx.npy', np.array([width] + self._offsets, dtype=np.int64))
+
+
 class DataReader(object):
     """
     Read data and create batches for training and testing.
+    Training sentence pairs can be split into `num_shards` disjoint shards (by stride), of which only the `shard`-th
+    is read, e.g. by one of several training workers.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, shard=0, num_shards=1):
         self._config = config
-        self._tmps = set()
+        self._shard = shard
+        self._num_shards = num_shards
+        self._line_offsets = {}
+        self._teacher_topk = None
         self.load_vocab()
 
-    def __del__(self):
-        for fname in self._tmps:
-            if os.path.exists(fname):
-                os.remove(fname)
-
     def load_vocab(self):
         """
         Load vocab from disk.
@@ -65,126 +137,205 @@ class DataReader(object):
         logging.debug('Load vocabularies %s and %s.' % (self._config.src_vocab, self._config.dst_vocab))
         self.src2idx, self.idx2src = load_vocab_(self._config.src_vocab, self._config.src_vocab_size)
         self.dst2idx, self.idx2dst = load_vocab_(self._config.dst_vocab, self._config.dst_vocab_size)
+        # Arrays of words for converting indices to words with numpy indexing.
+        self.src_words = np.array([self.idx2src[i] for i in range(len(self.idx2src))], dtype=object)
+        self.dst_words = np.array([self.idx2dst[i] for i in range(len(self.idx2dst))], dtype=object)
 
-    def get_training_batches(self, shuffle=True, epoches=None):
+    def get_training_batches(self, shuffle=True, epoches=None, first_epoch=1):
         """
         Generate batches according to bucket setting.
+        `first_epoch` is the number of the first generated epoch, which decides the order of a seeded shuffle.
         """
-        buckets = [(i, i) for i in range(5, 1000000, 3)]
+        # A bucket is identified by its boundary, the exclusive upper bound of the source and target lengths.
+        # Boundaries are 5, 8, 11, ... if train.bucket_boundaries is not set.
+        boundaries = sorted(self._config.train.bucket_boundaries or [])
 
         def select_bucket(sl, dl):
-            for l1, l2 in buckets:
-                if sl < l1 and dl < l2:
-                    return l1, l2
-            raise Exception("The sequence is too long: ({}, {})".format(sl, dl))
+            l = max(sl, dl)
+            if not boundaries:
+                return 5 + 3 * max(0, (l - 5) // 3 + 1)
+            i = bisect.bisect_right(boundaries, l)
+            return boundaries[i] if i < len(boundaries) else None
 
-        # Shuffle the training files.
-        src_path = self._config.train.src_path
-        dst_path = self._config.train.dst_path
         max_length = self._config.train.max_length
 
-        epoch = [0]
+        epoch = [first_epoch - 1]
 
         def stop_condition():
+            epoch[0] += 1
             if epoches is None:
                 return True
             else:
-                epoch[0] += 1
-                return epoch[0] < epoches + 1
+                return epoch[0] < first_epoch + epoches
 
         while stop_condition():
-            if shuffle:
-                logging.debug('Shuffle files %s and %s.' % (src_path, dst_path))
-                src_shuf_path, dst_shuf_path = self.shuffle([src_path, dst_path])
-                self._tmps.add(src_shuf_path)
-                self._tmps.add(dst_shuf_path)
+            order = self.shuffled_order(epoch[0]) if shuffle else None
+            if self._num_shards > 1:
+                if order is None:
+                    order = np.arange(self.num_training_sents())
+                order = order[order % self._num_shards == self._shard]
+            if self._config.train.src_bin_path and self._config.train.dst_bin_path:
+                pairs = self.get_binary_training_pairs(order)
             else:
-                src_shuf_path = src_path
-                dst_shuf_path = dst_path
-
-            caches = {}
-            for bucket in buckets:
-                caches[bucket] = [[], [], 0, 0]  # src sentences, dst sentences, src tokens, dst tokens
-
-            for src_sent, dst_sent in izip(open(src_shuf_path, 'r'), open(dst_shuf_path, 'r')):
-                src_sent, dst_sent = src_sent.decode('utf8'), dst_sent.decode('utf8')
-
-                src_sent = src_sent.split()
-                dst_sent = dst_sent.split()
-
-                # A special data augment method for training PTransformer model.
-                # if self._config.model == 'PTransformer' and self._config.data_augment:
-                #     s = np.random.randint(2-self._config.num_parallel, self._config.num_parallel)
-                #     s = max(0, s)
-                #     s = ['<S>'] * s
-                #     src_sent = s + src_sent
-                #     dst_sent = s + dst_sent
-
-                if len(src_sent) > max_length or len(dst_sent) > max_length:
-                    continue
-
-                bucket = select_bucket(len(src_sent), len(dst_sent))
-                if bucket is None:  # No bucket is selected when the sentence length exceed the max length.
-                    continue
-
-                caches[bucket][0].append(src_sent)
-                caches[bucket][1].append(dst_sent)
-                caches[bucket][2] += len(src_sent)
-                caches[bucket][3] += len(dst_sent)
-
-                if max(caches[bucket][2], caches[bucket][3]) >= self._config.train.tokens_per_batch:
-                    batch = (self.create_batch(caches[bucket][0], o='src'), self.create_batch(caches[bucket][1], o='dst'))
-                    logging.debug(
-                        'Yield batch with source shape %s and target shape %s.' % (batch[0].shape, batch[1].shape))
-                    yield batch
-                    caches[bucket] = [[], [], 0, 0]
+                pairs = self.get_text_training_pairs(order)
+            # Indices of the sentence pairs, by which cached teacher predictions are looked up.
+            indices = count() if order is None else order
+
+            caches = {}  # bucket -> [src sentences, dst sentences, src tokens, dst tokens, sentence indices]
+
+            try:
+                for index, (src_sent, dst_sent) in izip(indices, pairs):
+
+                    # A special data augment method for training PTransformer model.
+                    # if self._config.model == 'PTransformer' and self._config.data_augment:
+                    #     s = np.random.randint(2-self._config.num_parallel, self._config.num_parallel)
+                    #     s = max(0, s)
+                    #     s = ['<S>'] * s
+                    #     src_sent = s + src_sent
+                    #     dst_sent = s + dst_sent
+
+                    if len(src_sent) > max_length or len(dst_sent) > max_length:
+                        continue
+
+                    bucket = select_bucket(len(src_sent), len(dst_sent))
+                    if bucket is None:  # No bucket is selected when the sentence length exceed the max length.
+                        continue
+
+                    if bucket not in caches:
+                        caches[bucket] = [[], [], 0, 0, []]
+                    caches[bucket][0].append(src_sent)
+                    caches[bucket][1].append(dst_sent)
+                    caches[bucket][2] += len(src_sent)
+                    caches[bucket][3] += len(dst_sent)
+                    caches[bucket][4].append(index)
+
+                    if max(caches[bucket][2], caches[bucket][3]) >= self._config.train.tokens_per_batch:
+                        batch = self.create_training_batch(caches[bucket])
+                        logging.debug(
+                            'Yield batch with source shape %s and target shape %s.' % (batch[0].shape, batch[1].shape))
+                        yield batch
+                        del caches[bucket]
+            finally:
+                pairs.close()
 
             # Clean remain sentences.
-            for bucket in buckets:
+            for bucket in sorted(caches):
                 # Ensure each device at least get one sample.
                 if len(caches[bucket][0]) >= max(1, self._config.train.num_gpus):
-                    batch = (self.create_batch(caches[bucket][0], o='src'), self.create_batch(caches[bucket][1], o='dst'))
+                    batch = self.create_training_batch(caches[bucket])
                     logging.debug(
                         'Yield batch with source shape %s and target shape %s.' % (batch[0].shape, batch[1].shape))
                     yield batch
 
-            # Remove shuffled files when epoch finished.
-            if shuffle:
-                os.remove(src_shuf_path)
-                os.remove(dst_shuf_path)
-                self._tmps.remove(src_shuf_path)
-                self._tmps.remove(dst_shuf_path)
-
-    @staticmethod
-    def shuffle(list_of_files):
-        tf_os, tpath = mkstemp()
-        tf = open(tpath, 'w')
-
-        fds = [open(ff) for ff in list_of_files]
-
-        for l in fds[0]:
-            lines = [l.strip()] + [ff.readline().strip() for ff in fds[1:]]
-            print("<CONCATE4SHUF>".join(lines), file=tf)
-
-        [ff.close() for ff in fds]
-        tf.close()
-
-        os.system('shuf %s > %s' % (tpath, tpath + '.shuf'))
+    def create_training_batch(self, cache):
+        """
+        Create padded source and target batches from a bucket cache.
+        If train.teacher_topk_path is set, padded batches of the cached top-k ids and probabilities of a teacher
+        model (see teacher_topk.py) at the target positions follow.
+        """
+        src_sents, dst_sents, _, _, indices = cache
+        batch = (self.pad_batch(src_sents), self.pad_batch(dst_sents))
+        if self._config.train.teacher_topk_path:
+            if self._teacher_topk is None:
+                prefix = self._config.train.teacher_topk_path
+                self._teacher_topk = (BinaryCorpus(prefix + '.ids'), BinaryCorpus(prefix + '.probs', np.float16))
+            teacher_ids, teacher_probs = self._teacher_topk
+            k = teacher_ids.width
+            ids = np.zeros(batch[1].shape + (k,), np.int32)
+            probs = np.zeros(batch[1].shape + (k,), np.float32)
+            for j, (index, dst_sent) in enumerate(izip(indices, dst_sents)):
+                # Predictions of the target words and </S>.
+                assert len(teacher_ids[index]) == len(dst_sent) + 1, 'Teacher predictions are not aligned.'
+                ids[j, :len(dst_sent) + 1] = teacher_ids[index]
+                probs[j, :len(dst_sent) + 1] = teacher_probs[index]
+            batch += (ids, probs)
+        return batch
+
+    def shuffled_order(self, epoch):
+        """
+        Return a random permutation of the training sentence pairs.
+        If train.shuffle_seed is set, the permutation is decided by the seed and the epoch number.
+        """
+        num_sents = self.num_training_sents()
+        if self._config.train.shuffle_seed is None:
+            rng = np.random.RandomState()
+        else:
+            rng = np.random.RandomState([self._config.train.shuffle_seed, epoch])
+        logging.debug('Shuffle %d training sentence pairs.' % num_sents)
+        return rng.permutation(num_sents)
 
-        fnames = ['/tmp/{}.{}.{}.shuf'.format(i, os.getpid(), time.time()) for i, ff in enumerate(list_of_files)]
-        fds = [open(fn, 'w') for fn in fnames]
+    def num_training_sents(self):
+        if self._config.train.src_bin_path and self._config.train.dst_bin_path:
+            return len(BinaryCorpus(self._config.train.src_bin_path))
+        else:
+            return len(self.line_offsets(self._config.train.src_path)) - 1
 
-        for l in open(tpath + '.shuf'):
-            s = l.strip().split('<CONCATE4SHUF>')
-            for i, fd in enumerate(fds):
-                print(s[i], file=fd)
+    def line_offsets(self, path):
+        """
+        Return the byte offsets of the lines in a text file, followed by the size of the file.
+        Offsets are computed once and cached.
+        """
+        if path not in self._line_offsets:
+            offsets = [np.zeros([1], np.int64)]
+            size = 0
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(1 << 24)
+                    if not chunk:
+                        break
+                    offsets.append(np.flatnonzero(np.frombuffer(chunk, np.uint8) == ord('\n')) + size + 1)
+                    size += len(chunk)
+            offsets = np.concatenate(offsets)
+            if offsets[-1] != size:  # The last line is not ended with a newline.
+                offsets = np.append(offsets, size)
+            self._line_offsets[path] = offsets
+        return self._line_offsets[path]
+
+    def get_text_training_pairs(self, order=None):
+        """
+        Read training sentence pairs (as lists of indices) from the text files for one epoch.
+        If `order` is given, lines are read in that order by seeking to their offsets.
+        """
+        src_path = self._config.train.src_path
+        dst_path = self._config.train.dst_path
 
-        [ff.close() for ff in fds]
+        if order is None:
+            lines = izip(open(src_path, 'r'), open(dst_path, 'r'))
+        else:
+            lines = self.read_lines([src_path, dst_path], order)
 
-        os.remove(tpath)
-        os.remove(tpath + '.shuf')
+        for src_sent, dst_sent in lines:
+            src_sent, dst_sent = src_sent.decode('utf8'), dst_sent.decode('utf8')
 
-        return fnames
+            src_sent = [self.src2idx.get(word, 1) for word in src_sent.split()]  # 1: OOV
+            dst_sent = [self.dst2idx.get(word, 1) for word in dst_sent.split()]
+            yield src_sent, dst_sent
+
+    def read_lines(self, list_of_files, order):
+        """Read lines of the parallel files in the given order."""
+        offsets = [self.line_offsets(path) for path in list_of_files]
+        assert all(len(o) == len(offsets[0]) for o in offsets)
+        fds = [open(path, 'rb') for path in list_of_files]
+        try:
+            for i in order:
+                lines = []
+                for o, fd in zip(offsets, fds):
+                    fd.seek(o[i])
+                    lines.append(fd.read(o[i + 1] - o[i]))
+                yield lines
+        finally:
+            [fd.close() for fd in fds]
+
+    def get_binary_training_pairs(self, order=None):
+        """
+        Read training sentence pairs (as arrays of indices) from the binary corpora (see binarize.py) for one epoch.
+        Corpora are memory-mapped and read in the given order.
+        """
+        src_corpus = BinaryCorpus(self._config.train.src_bin_path)
+        dst_corpus = BinaryCorpus(self._config.train.dst_bin_path)
+        assert len(src_corpus) == len(dst_corpus)
+        for i in (xrange(len(src_corpus)) if order is None else order):
+            yield src_corpus[i], dst_corpus[i]
 
     def get_test_batches(self, src_path, batch_size):
         # Read batches for testing.
@@ -203,6 +354,55 @@ class DataReader(object):
                 src_sents.extend([src_sents[-1]] * self._config.test.num_gpus)
             yield self.create_batch(src_sents, o='src')
 
+    def get_test_batches_with_indices(self, src_path, batch_size):
+        """
+        Read batches for testing, together with the line numbers of the sentences in each batch.
+        If test.sort_by_length is set, sentences in each window of test.sort_window lines (the whole file by
+        default) are sorted by length, and a batch is also limited to test.tokens_per_batch tokens (padding
+        included), so that few computation is wasted on padding. Use the line numbers to restore the order.
+        Returns:
+            Line numbers and padded source batches.
+        """
+        sort_by_length = self._config.test.sort_by_length
+        window = self._config.test.sort_window if sort_by_length else batch_size
+        tokens_per_batch = self._config.test.tokens_per_batch if sort_by_length else None
+
+        def create_batch(batch):
+            indices, src_sents = zip(*batch)
+            src_sents = list(src_sents)
+            # We ensure batch size not small than gpu number by padding redundant samples.
+            if len(src_sents) < self._config.test.num_gpus:
+                src_sents.extend([src_sents[-1]] * self._config.test.num_gpus)
+            return list(indices), self.create_batch(src_sents, o='src')
+
+        def create_batches(sents):
+            if sort_by_length:
+                sents = sorted(sents, key=lambda x: len(x[1]))
+            batch, max_len = [], 0
+            for index, src_sent in sents:
+                length = len(src_sent) + 1  # </S>
+                if batch and (len(batch) >= batch_size or
+                              tokens_per_batch and (len(batch) + 1) * max(max_len, length) > tokens_per_batch):
+                    yield create_batch(batch)
+                    batch, max_len = [], 0
+                batch.append((index, src_sent))
+                max_len = max(max_len, length)
+            if batch:
+                yield create_batch(batch)
+
+        sents = []
+        for index, src_sent in enumerate(open(src_path, 'r')):
+            src_sent = src_sent.decode('utf8')
+            src_sent = src_sent.split()
+            sents.append((index, src_sent))
+            if window and len(sents) >= window:
+                for batch in create_batches(sents):
+                    yield batch
+                sents = []
+        if sents:
+            for batch in create_batches(sents):
+                yield batch
+
     def get_test_batches_with_target(self, src_path, dst_path, batch_size):
         """
         Usually we don't need target sentences for test unless we want to compute PPl.
@@ -228,42 +428,259 @@ class DataReader(object):
         # Convert words to indices.
         assert o in ('src', 'dst')
         word2idx = self.src2idx if o == 'src' else self.dst2idx
-        indices = []
-        for sent in sents:
-            x = [word2idx.get(word, 1) for word in (sent + [u"</S>"])]  # 1: OOV, </S>: End of Text
-            indices.append(x)
-
-        # Pad to the same length.
-        maxlen = max([len(s) for s in indices])
-        X = np.zeros([len(indices), maxlen], np.int32)
-        for i, x in enumerate(indices):
-            X[i, :len(x)] = x
+        lengths = np.array([len(sent) for sent in sents])
+        # Words are looked up in the dict one by one. A vectorized lookup (np.searchsorted on the sorted vocabulary)
+        # has to copy the words into a numpy array first and compares O(log V) strings per word, see
+        # benchmarks/batch_conversion.py. Training batches of binary corpora skip the lookup.
+        get = word2idx.get
+        flat = np.array([get(word, 1) for word in chain.from_iterable(sents)], np.int32)  # 1: OOV
+        return self.pad_batch(flat, lengths)
 
+    @staticmethod
+    def pad_batch(indices, lengths=None):
+        """
+        Append </S> (3) to each sequence of indices and pad them to the same length.
+        Args:
+            indices: A list of sequences of indices, or all indices concatenated if `lengths` is given.
+            lengths: Lengths of the sequences.
+        """
+        if lengths is None:
+            lengths = np.array([len(x) for x in indices])
+            if len(indices) > 0 and isinstance(indices[0], np.ndarray):
+                indices = np.concatenate(indices)
+            else:
+                indices = np.fromiter(chain.from_iterable(indices), np.int32, lengths.sum())
+        X = np.zeros([len(lengths), np.max(lengths) + 1], np.int32)
+        # Scatter the concatenated indices into the rows in row-major order.
+        X[np.arange(X.shape[1]) < lengths[:, None]] = indices
+        X[np.arange(len(lengths)), lengths] = 3  # </S>: End of Text
         return X
 
     def indices_to_words(self, Y, o='dst'):
         assert o in ('src', 'dst')
-        idx2word = self.idx2src if o == 'src' else self.idx2dst
-        sents = []
-        for y in Y: # for each sentence
-            sent = []
-            for i in y:  # For each word
-                if i == 3:  # </S>
+        words = self.src_words if o == 'src' else self.dst_words
+        Y = np.asarray(Y)
+        # Sentences end before the first </S> (3), or at the end of the row.
+        is_eos = Y == 3
+        ends = np.where(is_eos.any(axis=1), is_eos.argmax(axis=1), Y.shape[1])
+        Y = words[Y]
+        return [' '.join(y[:end]) for y, end in zip(Y, ends)]
+
+
+class Prefetcher(object):
+    """
+    Run a generator in background (a thread or a process) and buffer its items in a bounded queue,
+    so that the consumer seldom waits for them.
+    """
+
+    def __init__(self, generator_fn, capacity, use_process=False):
+        """
+        Args:
+            generator_fn: A callable returning the generator to run.
+            capacity: The max number of buffered items.
+            use_process: Whether to run the generator in a process instead of a thread. Items are pickled.
+        """
+        self._generator_fn = generator_fn
+        if use_process:
+            self._queue = multiprocessing.Queue(maxsize=capacity)
+            self._stop = multiprocessing.Event()
+            self._worker = multiprocessing.Process(target=self._produce)
+        else:
+            self._queue = Queue(maxsize=capacity)
+            self._stop = threading.Event()
+            self._worker = threading.Thread(target=self._produce)
+        self._worker.daemon = True
+        self.num_gets = 0
+        self.num_empty_gets = 0
+
+    def _put(self, element):
+        """Put an element into the queue, unless the consumer stopped. Return whether it was put."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(element, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce(self):
+        # Each element in the queue is a pair (finished, item or exception).
+        generator = self._generator_fn()
+        try:
+            for item in generator:
+                if not self._put((False, item)):
                     break
-                w = idx2word[i]
-                sent.append(w)
-            sents.append(' '.join(sent))
-        return sents
+            else:
+                self._put((True, None))
+        except Exception as e:
+            logging.exception('Prefetching failed.')
+            self._put((True, e))
+        finally:
+            generator.close()
+            if self._stop.is_set() and hasattr(self._queue, 'cancel_join_thread'):
+                # Do not wait for elements that will never be consumed.
+                self._queue.cancel_join_thread()
+
+    def __iter__(self):
+        self._worker.start()
+        try:
+            while True:
+                try:
+                    finished, item = self._queue.get_nowait()
+                    empty = False
+                except Empty:
+                    finished, item = self._queue.get()
+                    empty = True
+                if finished:
+                    if item is not None:
+                        raise item
+                    return
+                self.num_gets += 1
+                self.num_empty_gets += empty
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the background worker and wait for it to clean up."""
+        self._stop.set()
+        if self._worker.is_alive():
+            self._worker.join()
+
+    @property
+    def empty_fraction(self):
+        """The fraction of gets that found the queue empty, i.e. the consumer had to wait."""
+        return self.num_empty_gets / float(max(1, self.num_gets))
+
+
+class AsyncSaver(object):
+    """
+    Save checkpoints in background. Values of variables are copied to host memory when `save` is called, and
+    written to disk by a thread with a private graph and session, so that training is not blocked by serialization.
+    """
 
+    def __init__(self, var_list=None, max_to_keep=5, max_pending=1):
+        """
+        Args:
+            var_list: Variables to save, all global variables by default.
+            max_to_keep: The max number of recent checkpoints to keep.
+            max_pending: The max number of snapshots waiting to be written. `save` blocks when the number is reached.
+        """
+        self._var_list = list(var_list) if var_list is not None else tf.global_variables()
+        self._graph = tf.Graph()
+        with self._graph.as_default(), tf.device('/cpu:0'):
+            self._placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in self._var_list]
+            # Variables are initialized by the fed values.
+            variables = [tf.Variable(p, trainable=False) for p in self._placeholders]
+            self._init_op = tf.variables_initializer(variables)
+            self._saver = tf.train.Saver({v.op.name: w for v, w in zip(self._var_list, variables)},
+                                         max_to_keep=max_to_keep)
+        self._sess = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+        self._queue = Queue(maxsize=max_pending)
+        self._error = None
+        self._worker = threading.Thread(target=self._write)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            values, save_path, global_step = item
+            try:
+                self._sess.run(self._init_op, feed_dict=dict(zip(self._placeholders, values)))
+                self._saver.save(self._sess, save_path, global_step=global_step, write_meta_graph=False)
+                logging.info('Checkpoint %s is written.' % save_path)
+            except Exception as e:
+                logging.exception('Writing checkpoint failed.')
+                self._error = e
+
+    def _check_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    def save(self, sess, save_path, global_step=None):
+        """Snapshot variables in `sess` and write them to `save_path` later."""
+        self._check_error()
+        values = sess.run(self._var_list)
+        self._queue.put((values, save_path, global_step))
+        return save_path
+
+    def close(self):
+        """Wait for pending checkpoints to be written."""
+        if self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join()
+        self._sess.close()
+        self._check_error()
+
+
+class TranslationCache(object):
+    """
+    A LRU cache of translations. If `path` is given, the cache is loaded from it if it exists, and `save` writes
+    the cache back to it, so that it is shared by runs.
+    """
 
-def expand_feed_dict(feed_dict):
+    def __init__(self, capacity, path=None):
+        """
+        Args:
+            capacity: The max number of cached translations, the least recently used ones are evicted.
+            path: The file to persist the cache, or None to keep it in memory only.
+        """
+        self._capacity = capacity
+        self._path = path
+        self._items = OrderedDict()
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                for key, value in cPickle.load(f):
+                    self.put(key, value)
+            logging.info('Load {} cached translations from {}.'.format(len(self._items), path))
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """The cached translation of `key`, or None."""
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value  # Most recently used.
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self._capacity:
+            self._items.popitem(last=False)
+
+    def save(self):
+        """Write the cache to `path`, if given."""
+        if not self._path:
+            return
+        with open(self._path + '.tmp', 'wb') as f:
+            cPickle.dump(self._items.items(), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(self._path + '.tmp', self._path)
+
+
+def expand_feed_dict(feed_dict, partition=None):
     """If the key is a tuple of placeholders,
     split the input data then feed them into these placeholders.
+    By default the data is split into contiguous spans with equal numbers of rows. If a partition
+    (see balanced_partition) is given, the rows are split according to it, and each split of a 2-D int array
+    is trimmed to its own max length.
     """
     new_feed_dict = {}
     for k, v in feed_dict.items():
         if type(k) is not tuple:
             new_feed_dict[k] = v
+        elif partition is not None:
+            assert len(partition) == len(k)
+            for p, indices in zip(k, partition):
+                split = v[indices]
+                if split.ndim == 2 and np.issubdtype(split.dtype, np.integer):
+                    split = split[:, :max(1, np.max(np.sum(np.not_equal(split, 0), axis=1)))]
+                new_feed_dict[p] = split
         else:
             # Split v along the first dimension.
             n = len(k)
@@ -282,6 +699,30 @@ def expand_feed_dict(feed_dict):
     return new_feed_dict
 
 
+def balanced_partition(batches, n):
+    """
+    Partition the rows of aligned batches into n splits with approximately equal numbers of tokens, so that
+    synchronized towers get similar loads. Rows are sorted by length before partition, hence rows in a split
+    have similar lengths and need little padding.
+    Args:
+        batches: A list of padded int arrays with the same number of rows, e.g. [source batch, target batch].
+        n: The number of splits. It should not be greater than the number of rows.
+
+    Returns:
+        A list of n index arrays.
+    """
+    lengths = sum(np.sum(np.not_equal(b, 0), axis=1) for b in batches)
+    assert len(lengths) >= n > 0
+    order = np.argsort(lengths, kind='mergesort')
+    cum_tokens = np.cumsum(lengths[order])
+    # Split points in the sorted rows, each split gets at least one row.
+    points = np.searchsorted(cum_tokens, cum_tokens[-1] * np.arange(1, n) / float(n))
+    points = np.maximum(points, np.arange(1, n))
+    points = np.minimum(points, len(lengths) - np.arange(n - 1, 0, -1))
+    points = np.maximum.accumulate(points)
+    return np.split(order, points)
+
+
 def available_variables(checkpoint_dir):
     all_vars = tf.global_variables()
     all_available_vars = tff.list_variables(checkpoint_dir=checkpoint_dir)
@@ -342,10 +783,29 @@ def residual(inputs, outputs, dropout_rate):
         A Tensor.
     """
     outputs = inputs + tf.nn.dropout(outputs, 1 - dropout_rate)
-    outputs = common_layers.layer_norm(outputs)
+    # Layer normalization is computed in float32 for float16 inputs.
+    outputs = tf.cast(common_layers.layer_norm(tf.cast(outputs, tf.float32)), inputs.dtype)
     return outputs
 
 
+def float32_variable_storage_getter(getter, name, *args, **kwargs):
+    """
+    Custom getter for mixed precision training. Trainable variables requested in float16 are created in float32
+    and cast to float16, so that the computation is in float16 while the optimizer updates float32 variables.
+    """
+    if kwargs.get('dtype') != tf.float16 or not kwargs.get('trainable', True):
+        return getter(name, *args, **kwargs)
+    kwargs['dtype'] = tf.float32
+    return tf.cast(getter(name, *args, **kwargs), tf.float16)
+
+
+def cast_attention_bias(bias, dtype):
+    """Cast an attention bias, the large negative values of masked positions are clipped to be finite in float16."""
+    if dtype == tf.float16:
+        bias = tf.maximum(bias, -1e4)
+    return tf.cast(bias, dtype)
+
+
 def learning_rate_decay(config, global_step):
     """Inverse-decay learning rate until warmup_steps, then decay."""
     warmup_steps = tf.to_float(config.train.warmup_steps)
@@ -354,6 +814,28 @@ def learning_rate_decay(config, global_step):
         (global_step + 1.0) * warmup_steps ** -1.5, (global_step + 1.0) ** -0.5)
 
 
+def shape_invariants(structure, batch_only=False):
+    """
+    Loose shape invariants for a nested structure of tensors in tf.while_loop.
+    Only the rank is kept, or all but the first dimension are kept if batch_only is True.
+    """
+    if batch_only:
+        return nest.map_structure(lambda t: tf.TensorShape([None]).concatenate(t.get_shape()[1:]), structure)
+    return nest.map_structure(lambda t: tf.TensorShape([None] * t.get_shape().ndims), structure)
+
+
+def tile_to_beam(x, beam_size):
+    """Repeat each item of x beam_size times along the first axis, i.e. [batch, ...] -> [batch * beam_size, ...]."""
+    if beam_size == 1:
+        return x
+    shape = tf.shape(x)
+    multiples = [1, beam_size] + [1] * (x.get_shape().ndims - 1)
+    tiled = tf.tile(x[:, None], multiples=multiples)
+    tiled = tf.reshape(tiled, tf.concat([[shape[0] * beam_size], shape[1:]], axis=0))
+    tiled.set_shape([None] + x.get_shape().as_list()[1:])
+    return tiled
+
+
 def shift_right(input, pad=2):
     """Shift input tensor right to create decoder input. '2' denotes <S>"""
     return tf.concat((tf.ones_like(input[:, :1]) * pad, input[:, :-1]), 1)
@@ -394,10 +876,10 @@ def dense(inputs,
                 w = kernel
             else:
                 with tf.variable_scope(tf.get_variable_scope()):
-                    w = tf.get_variable("kernel", [output_size, input_size])
+                    w = tf.get_variable("kernel", [output_size, input_size], dtype=inputs.dtype)
             outputs = tf.matmul(inputs, w, transpose_b=True)
             if use_bias:
-                b = tf.get_variable("bias", [output_size], initializer=tf.zeros_initializer)
+                b = tf.get_variable("bias", [output_size], dtype=inputs.dtype, initializer=tf.zeros_initializer)
                 outputs += b
             outputs = activation(outputs)
             return tf.reshape(outputs, inputs_shape[:-1] + [output_size])
@@ -414,6 +896,97 @@ def ff_hidden(inputs, hidden_size, output_size, activation, use_bias=True, reuse
         return outputs
 
 
+def chunked_smoothing_cross_entropy(inputs, kernel, labels, vocab_size, confidence, chunk_size):
+    """
+    Label smoothed cross entropy (see common_layers.smoothing_cross_entropy) of the logits `inputs * kernel^T`.
+    The projection and the loss are fused and computed chunk by chunk, so that neither the logits nor the soft
+    targets of all positions are materialized. Logits of each chunk are recomputed for the gradients.
+
+    Args:
+        inputs: A Tensor with shape [n, hidden_size].
+        kernel: A Tensor with shape [vocab_size, hidden_size].
+        labels: An int Tensor with shape [n].
+        vocab_size: An int.
+        confidence: A float. Probability of the true label.
+        chunk_size: An int. Number of positions in a chunk.
+
+    Returns:
+        A Tensor with shape [n] of losses and an int Tensor with shape [n] of the predictions (argmax of logits).
+    """
+    low_confidence = (1.0 - confidence) / (vocab_size - 1)
+    # The best cross entropy value with soft targets.
+    normalizing = -(confidence * np.log(confidence) +
+                    (vocab_size - 1) * low_confidence * np.log(low_confidence + 1e-20))
+    labels = tf.to_int32(labels)
+    num_chunks = (tf.shape(inputs)[0] + chunk_size - 1) // chunk_size
+
+    def chunk(x, i):
+        return x[i * chunk_size: (i + 1) * chunk_size]
+
+    @tf.custom_gradient
+    def loss_fn(inputs, kernel):
+
+        def step(i, losses, preds):
+            logits = tf.matmul(chunk(inputs, i), kernel, transpose_b=True)
+            y = chunk(labels, i)
+            true_logits = tf.gather_nd(logits, tf.stack([tf.range(tf.shape(y)[0]), y], axis=1))
+            loss = tf.reduce_logsumexp(logits, axis=-1) - (confidence - low_confidence) * true_logits \
+                - low_confidence * tf.reduce_sum(logits, axis=-1) - normalizing
+            return i + 1, losses.write(i, loss), preds.write(i, tf.to_int32(tf.argmax(logits, axis=-1)))
+
+        _, losses, preds = tf.while_loop(lambda i, *_: i < num_chunks, step,
+                                         [0,
+                                          tf.TensorArray(tf.float32, size=num_chunks, infer_shape=False),
+                                          tf.TensorArray(tf.int32, size=num_chunks, infer_shape=False)],
+                                         parallel_iterations=1,
+                                         back_prop=False)
+
+        def grad_fn(d_losses, _):
+
+            def step(i, d_inputs, d_kernel):
+                x = chunk(inputs, i)
+                logits = tf.matmul(x, kernel, transpose_b=True)
+                soft_targets = tf.one_hot(chunk(labels, i), depth=vocab_size,
+                                          on_value=confidence, off_value=low_confidence)
+                d_logits = (tf.nn.softmax(logits) - soft_targets) * chunk(d_losses, i)[:, None]
+                return i + 1, d_inputs.write(i, tf.matmul(d_logits, kernel)), \
+                    d_kernel + tf.matmul(d_logits, x, transpose_a=True)
+
+            _, d_inputs, d_kernel = tf.while_loop(lambda i, *_: i < num_chunks, step,
+                                                  [0,
+                                                   tf.TensorArray(tf.float32, size=num_chunks, infer_shape=False),
+                                                   tf.zeros_like(kernel)],
+                                                  parallel_iterations=1,
+                                                  back_prop=False)
+            return d_inputs.concat(), d_kernel
+
+        return (losses.concat(), preds.concat()), grad_fn
+
+    return loss_fn(inputs, kernel)
+
+
+def topk_cross_entropy(logits, ids, probs):
+    """
+    Cross entropy of logits against sparse target distributions, e.g. the top-k predictions of a teacher model.
+    The probabilities are renormalized over the k ids, and only k logits of each position are gathered.
+
+    Args:
+        logits: A Tensor with shape [batch_size, length, vocab_size].
+        ids: An int Tensor with shape [batch_size, length, k].
+        probs: A Tensor with shape [batch_size, length, k].
+
+    Returns:
+        A Tensor with shape [batch_size, length].
+    """
+    shape = tf.shape(ids)
+    # Gather by [batch, position, id] indices, a flat index into the logits may overflow int32.
+    batch_indices = tf.tile(tf.reshape(tf.range(shape[0]), [-1, 1, 1]), [1, shape[1], shape[2]])
+    position_indices = tf.tile(tf.reshape(tf.range(shape[1]), [1, -1, 1]), [shape[0], 1, shape[2]])
+    topk_logits = tf.gather_nd(logits, tf.stack([batch_indices, position_indices, tf.to_int32(ids)], axis=-1))
+    probs /= tf.maximum(tf.reduce_sum(probs, axis=-1, keep_dims=True), 1e-20)
+    return tf.reduce_logsumexp(logits, axis=-1) - tf.reduce_sum(probs * topk_logits, axis=-1)
+
+
 def multihead_attention(query_antecedent,
                         memory_antecedent,
                         bias,
@@ -426,6 +999,7 @@ def multihead_attention(query_antecedent,
                         query_eq_key=False,
                         summaries=False,
                         image_shapes=None,
+                        cache=None,
                         name=None):
     """Multihead scaled-dot-product attention with input/output transformations.
 
@@ -445,6 +1019,10 @@ def multihead_attention(query_antecedent,
         If the query positions and memory positions represent the
         pixels of a flattened image, then pass in their dimensions:
           (query_rows, query_cols, memory_rows, memory_cols).
+    cache: an optional dict with keys 'k' and 'v'. For self-attention, it holds the keys and values (split by
+        heads) of previous positions and is updated in place. For attention over memory_antecedent, it holds
+        the keys and values returned by multihead_attention_memory, whose batch size may be a divisor of the
+        batch size of query_antecedent (see shared_memory_dot_product_attention).
     name: an optional string
 
     Returns:
@@ -463,6 +1041,11 @@ def multihead_attention(query_antecedent,
                 q, k, v = tf.split(
                   combined, [total_key_depth, total_key_depth, total_value_depth],
                   axis=2)
+            elif cache is not None:
+                # Q != K = V
+                # Keys and values of the memory are computed in advance (see multihead_attention_memory).
+                q = dense(query_antecedent, total_key_depth, name="q_transform")
+                k, v = None, None
             else:
                 # Q != K = V
                 q = dense(query_antecedent, total_key_depth, name="q_transform")
@@ -482,17 +1065,88 @@ def multihead_attention(query_antecedent,
             q = q[:, -num_queries:, :]
 
         q = common_attention.split_heads(q, num_heads)
-        k = common_attention.split_heads(k, num_heads)
-        v = common_attention.split_heads(v, num_heads)
+        if cache is not None and memory_antecedent is not None:
+            k, v = cache['k'], cache['v']
+        else:
+            k = common_attention.split_heads(k, num_heads)
+            v = common_attention.split_heads(v, num_heads)
+            if cache is not None:
+                # Only new positions are projected, keys and values of previous positions come from the cache.
+                k = tf.concat([cache['k'], k], axis=2)
+                v = tf.concat([cache['v'], v], axis=2)
+                cache['k'], cache['v'] = k, v
         key_depth_per_head = total_key_depth // num_heads
         q *= key_depth_per_head**-0.5
-        x = common_attention.dot_product_attention(
-            q, k, v, bias, dropout_rate, summaries, image_shapes)
+        if cache is not None and memory_antecedent is not None:
+            x = shared_memory_dot_product_attention(
+                q, k, v, bias, dropout_rate, summaries, image_shapes)
+        else:
+            x = common_attention.dot_product_attention(
+                q, k, v, bias, dropout_rate, summaries, image_shapes)
         x = common_attention.combine_heads(x)
         x = dense(x, output_depth, name="output_transform")
         return x
 
 
+def shared_memory_dot_product_attention(q, k, v, bias, dropout_rate, summaries=False, image_shapes=None):
+    """dot-product attention in which each memory is shared by n consecutive items of q along the batch axis,
+    e.g. all hypotheses in the beam of a sentence. The n queries are folded into the length axis, so the memory
+    needn't be tiled.
+
+    Args:
+    q: a Tensor with shape [batch * n, heads, length_q, depth_k]
+    k: a Tensor with shape [batch, heads, length_kv, depth_k]
+    v: a Tensor with shape [batch, heads, length_kv, depth_v]
+    bias: bias Tensor with shape [batch, 1, 1, length_kv] (see attention_bias_ignore_padding())
+    dropout_rate: a floating point number
+    summaries: a boolean
+    image_shapes: optional quadruple of integer scalars for image summary.
+
+    Returns:
+    A Tensor with shape [batch * n, heads, length_q, depth_v].
+    """
+    num_heads = q.get_shape()[1].value
+    depth_v = v.get_shape()[3].value
+    length_q = tf.shape(q)[2]
+    n = tf.shape(q)[0] // tf.shape(k)[0]
+    # [batch, heads, n * length_q, depth_k]
+    q = tf.reshape(q, [-1, n, num_heads, length_q, q.get_shape()[3].value])
+    q = tf.transpose(q, [0, 2, 1, 3, 4])
+    q = tf.reshape(q, [-1, num_heads, n * length_q, q.get_shape()[4].value])
+    x = common_attention.dot_product_attention(q, k, v, bias, dropout_rate, summaries, image_shapes)
+    # [batch * n, heads, length_q, depth_v]
+    x = tf.reshape(x, [-1, num_heads, n, length_q, depth_v])
+    x = tf.transpose(x, [0, 2, 1, 3, 4])
+    return tf.reshape(x, [-1, num_heads, length_q, depth_v])
+
+
+def multihead_attention_memory(memory_antecedent,
+                               total_key_depth,
+                               total_value_depth,
+                               num_heads,
+                               name=None):
+    """Compute the keys and values of memory_antecedent for multihead_attention in advance.
+
+    Args:
+    memory_antecedent: a Tensor with shape [batch, length_m, channels]
+    total_key_depth: an integer
+    total_value_depth: an integer
+    num_heads: an integer dividing total_key_depth and total_value_depth
+    name: an optional string, should be the same as the name passed to multihead_attention
+
+    Returns:
+    A dict with keys 'k' and 'v', which can be passed to multihead_attention as cache.
+    """
+    with tf.variable_scope(
+        name,
+        default_name="multihead_attention",
+        values=[memory_antecedent]):
+        combined = dense(memory_antecedent, total_key_depth + total_value_depth, name="kv_transform")
+        k, v = tf.split(combined, [total_key_depth, total_value_depth], axis=2)
+        return {'k': common_attention.split_heads(k, num_heads),
+                'v': common_attention.split_heads(v, num_heads)}
+
+
 class AttentionGRUCell(tf.nn.rnn_cell.GRUCell):
     def __init__(self,
                  num_units,
@@ -1,50 +1,115 @@
 import codecs
 import logging
+import multiprocessing
 import os
 from argparse import ArgumentParser
 from collections import Counter
+from itertools import izip
 
 import yaml
 
 from utils import AttrDict
 
 
-def make_vocab(fpath, fname):
+def byte_ranges(fpath, chunk_size):
+    """Splits a file into byte ranges of about `chunk_size` bytes."""
+    size = os.path.getsize(fpath)
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def count_words(args):
+    """Counts words of the lines starting in the byte range [start, end) of a file."""
+    fpath, start, end = args
+    word2cnt = Counter()
+    with open(fpath, 'rb') as f:
+        if start > 0:
+            # Skip the line that begins in the previous range.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            l = f.readline()
+            if not l:
+                break
+            word2cnt.update(l.decode('utf-8').split())
+    return word2cnt
+
+
+def make_vocabs(paths, num_workers=1, max_size=None, min_count=1, chunk_size=1 << 24):
+    """Constructs vocabularies of several files in a single pass with a process pool.
+
+    Args:
+      paths: A list of (input file path, output file name) pairs.
+      num_workers: An int. Number of processes counting words.
+      max_size: An int. Max number of words in a vocabulary (including <PAD>, <UNK>, <S> and </S>).
+      min_count: An int. Words appear less than `min_count` times are dropped.
+      chunk_size: An int. Number of bytes counted by a process at a time.
+
+    Writes vocabulary line by line to each output file name.
+    """
+    tasks, owners = [], []
+    for i, (fpath, _) in enumerate(paths):
+        for start, end in byte_ranges(fpath, chunk_size):
+            tasks.append((fpath, start, end))
+            owners.append(i)
+
+    counters = [Counter() for _ in paths]
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(count_words, tasks)
+    else:
+        pool = None
+        results = (count_words(task) for task in tasks)
+    # izip merges each counter as it arrives, zip would hold the counters of all chunks at once.
+    for i, word2cnt in izip(owners, results):
+        counters[i].update(word2cnt)
+    if pool:
+        pool.close()
+        pool.join()
+
+    for (_, fname), word2cnt in zip(paths, counters):
+        word2cnt.update({"<PAD>":   10000000000000,
+                         "<UNK>":   1000000000000,
+                         "<S>":     100000000000,
+                         "</S>":    10000000000})
+        words = [(word, cnt) for word, cnt in word2cnt.most_common(max_size) if cnt >= min_count]
+        with codecs.open(fname, 'w', 'utf-8') as fout:
+            for word, cnt in words:
+                fout.write(u"{}\t{}\n".format(word, cnt))
+        logging.info('Vocab path: {}\t size: {}'.format(fname, len(words)))
+
+
+def make_vocab(fpath, fname, **kwargs):
     """Constructs vocabulary.
-    
+
     Args:
       fpath: A string. Input file path.
       fname: A string. Output file name.
-    
+      kwargs: Options of `make_vocabs`.
+
     Writes vocabulary line by line to `fname`.
     """
-    word2cnt = Counter()
-    for l in codecs.open(fpath, 'r', 'utf-8'):
-        words = l.split()
-        word2cnt.update(Counter(words))
-    word2cnt.update({"<PAD>":   10000000000000,
-                     "<UNK>":   1000000000000,
-                     "<S>":     100000000000,
-                     "</S>":    10000000000})
-    with codecs.open(fname, 'w', 'utf-8') as fout:
-        for word, cnt in word2cnt.most_common():
-            fout.write(u"{}\t{}\n".format(word, cnt))
-    logging.info('Vocab path: {}\t size: {}'.format(fname, len(word2cnt)))
+    make_vocabs([(fpath, fname)], **kwargs)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--max-size', dest='max_size', type=int, default=None)
+    parser.add_argument('--min-count', dest='min_count', type=int, default=1)
     args = parser.parse_args()
     # Read config
     config = AttrDict(yaml.load(open(args.config)))
     logging.basicConfig(level=logging.INFO)
+    paths = []
     if os.path.exists(config.src_vocab):
         logging.info('Source vocab already exists at {}'.format(config.src_vocab))
     else:
-        make_vocab(config.train.src_path, config.src_vocab)
+        paths.append((config.train.src_path, config.src_vocab))
     if os.path.exists(config.dst_vocab):
         logging.info('Destination vocab already exists at {}'.format(config.dst_vocab))
     else:
-        make_vocab(config.train.dst_path, config.dst_vocab)
+        paths.append((config.train.dst_path, config.dst_vocab))
+    if paths:
+        make_vocabs(paths, num_workers=args.num_workers, max_size=args.max_size, min_count=args.min_count)
     logging.info("Done")